@@ -1,6 +1,13 @@
+import argparse
 import configparser
+import re
+import sys
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, table_info_select, table_def_select, \
+    TABLE_DESIGN, table_design_ddl
+
+# pg_class.reldiststyle values of the distribution styles
+RELDISTSTYLES = {0: 'EVEN', 1: 'KEY', 8: 'ALL'}
 
 
 def drop_tables(cur, conn):
@@ -25,11 +32,97 @@ def create_tables(cur, conn):
         cur.execute(query)
         conn.commit()
 
+def check_table_design():
+    '''
+    Checking the generated CREATE TABLE statements against TABLE_DESIGN, without a cluster.
+    Every table must end with its generated attributes and its key columns must exist.
+    :return: List of problems, empty when the DDL matches the design.
+    '''
+    problems = []
+    queries = dict((re.search(r'CREATE TABLE IF NOT EXISTS (\w+)', query).group(1), query)
+                   for query in create_table_queries)
+
+    for table in sorted(set(queries) - set(TABLE_DESIGN)):
+        problems.append('{}: no physical design in TABLE_DESIGN'.format(table))
+
+    for table, design in TABLE_DESIGN.items():
+        if table not in queries:
+            problems.append('{}: no CREATE TABLE statement'.format(table))
+            continue
+        query = queries[table]
+        columns = re.findall(r'^\s*(\w+)\s', re.search(r'\(\n(.*)\n\s*\)', query, re.S).group(1), re.M)
+
+        if design['diststyle'] not in ('ALL', 'EVEN', 'KEY'):
+            problems.append('{}: unknown DISTSTYLE {}'.format(table, design['diststyle']))
+        if (design['diststyle'] == 'KEY') != bool(design.get('distkey')):
+            problems.append('{}: a DISTKEY needs DISTSTYLE KEY and DISTSTYLE KEY a DISTKEY'.format(table))
+        for column in [design.get('distkey')] + design.get('sortkey', []):
+            if column and column not in columns:
+                problems.append('{}: key column {} is not in the table'.format(table, column))
+        if not query.rstrip().endswith(') ' + table_design_ddl(table)):
+            problems.append('{}: statement does not end with {}'.format(table, table_design_ddl(table)))
+
+    return problems
+
+def verify_table_design(cur):
+    '''
+    Verifying the distribution style and sort keys of the created tables against TABLE_DESIGN.
+    Tables are looked up in svv_table_info, which only lists tables holding data, and in
+    pg_table_def while they are still empty.
+    :param cur: Cursor used to execute query.
+    :return: List of mismatches, empty when the cluster matches the design.
+    '''
+    actual = {}
+
+    cur.execute(table_def_select)
+    keys = {}
+    for table, reldiststyle, column, distkey, sortkey in cur.fetchall():
+        diststyle, distkeys, sortkeys = keys.setdefault(table, (RELDISTSTYLES.get(reldiststyle, reldiststyle), [], []))
+        if distkey:
+            distkeys.append(column)
+        if sortkey:
+            sortkeys.append((abs(sortkey), column))
+    for table, (diststyle, distkeys, sortkeys) in keys.items():
+        if diststyle == 'KEY':
+            diststyle = 'KEY({})'.format(', '.join(distkeys))
+        actual[table] = (diststyle, min(sortkeys)[1] if sortkeys else None, len(sortkeys))
+
+    cur.execute(table_info_select)
+    for table, diststyle, sortkey1, sortkey_num in cur.fetchall():
+        actual[table] = (diststyle, sortkey1, sortkey_num)
+
+    mismatches = []
+    for table, design in TABLE_DESIGN.items():
+        sortkey = design.get('sortkey', [])
+        diststyle = 'KEY({})'.format(design['distkey']) if design['diststyle'] == 'KEY' else design['diststyle']
+        expected = (diststyle, sortkey[0] if sortkey else None, len(sortkey))
+        if table not in actual:
+            mismatches.append('{}: table not found'.format(table))
+        elif actual[table] != expected:
+            mismatches.append('{}: expected (diststyle, sortkey1, sortkey_num) {}, found {}'.format(
+                table, expected, actual[table]))
+    return mismatches
+
 def main():
     '''
-    Main function drops all tables and recreates them according to configuration stored in 'dwh.cfg' file.
+    Main function drops all tables and recreates them according to configuration stored in 'dwh.cfg' file,
+    then verifies their distribution and sort keys. With --check-ddl it only checks the generated DDL.
     :return: No return values.
     '''
+    parser = argparse.ArgumentParser(description='Recreate the Redshift staging, fact and dimension tables.')
+    parser.add_argument('--check-ddl', action='store_true',
+                        help='check the generated CREATE TABLE statements against TABLE_DESIGN without connecting')
+    args = parser.parse_args()
+
+    if args.check_ddl:
+        problems = check_table_design()
+        for query in create_table_queries:
+            print(query)
+        if problems:
+            sys.exit('\n'.join(problems))
+        print('DDL matches TABLE_DESIGN.')
+        return
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
@@ -39,7 +132,11 @@ def main():
     drop_tables(cur, conn)
     create_tables(cur, conn)
 
+    mismatches = verify_table_design(cur)
     conn.close()
+    if mismatches:
+        sys.exit('\n'.join(mismatches))
+    print('Table design verified.')
 
 
 if __name__ == "__main__":
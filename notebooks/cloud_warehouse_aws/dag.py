@@ -0,0 +1,143 @@
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def get_task_order(tasks):
+    '''
+    Order tasks so every task comes after the tasks it depends on.
+    :param tasks: Dict of task name to (statement, names of the tasks it depends on).
+    :return: List of task names.
+    '''
+    order, done, visiting = [], set(), set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name not in tasks:
+            raise ValueError('{} depends on unknown task {}'.format(path[-1], name))
+        if name in visiting:
+            raise ValueError('dependency cycle: {}'.format(' -> '.join(path + [name])))
+        visiting.add(name)
+        for dependency in tasks[name][1]:
+            visit(dependency, path + [name])
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in tasks:
+        visit(name, [])
+    return order
+
+
+def execute_task(idle, run, name, statement, start, timings):
+    '''
+    Run one statement on the next idle connection and commit it, rolling back on failure.
+    :param idle: Queue of idle connections, the connection is put back once done.
+    :param run: Function run(cur, name, statement) executing one statement.
+    :param name: Task name.
+    :param statement: Statement of the task.
+    :param start: perf_counter value of the start of the run.
+    :param timings: Dict the (start, end) seconds of the task are stored in.
+    :return: No values returned.
+    '''
+    conn = idle.get()
+    try:
+        started = time.perf_counter() - start
+        try:
+            with conn.cursor() as cur:
+                run(cur, name, statement)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        timings[name] = (started, time.perf_counter() - start)
+    finally:
+        idle.put(conn)
+
+
+def submit_ready(waiting, running, submit):
+    '''
+    Start the waiting tasks whose dependencies are all done.
+    :param waiting: Dict of task name to the set of its unfinished dependencies, started tasks are removed.
+    :param running: Dict of future to task name the started tasks are added to.
+    :param submit: Function submit(name) starting a task and returning its future.
+    :return: No values returned.
+    '''
+    for name in [name for name, dependencies in waiting.items() if not dependencies]:
+        del waiting[name]
+        running[submit(name)] = name
+
+
+def complete_done(done, waiting, running, error):
+    '''
+    Handle finished tasks: successful ones are removed from the dependencies of the waiting tasks.
+    :param done: Finished futures.
+    :param waiting: Dict of task name to the set of its unfinished dependencies.
+    :param running: Dict of future to task name, finished tasks are removed.
+    :param error: First error of the run so far, None without.
+    :return: First error of the run, None without.
+    '''
+    for future in done:
+        name = running.pop(future)
+        if future.exception() is not None:
+            error = error or future.exception()
+            continue
+        for dependencies in waiting.values():
+            dependencies.discard(name)
+    return error
+
+
+def run_dag(tasks, run, connections):
+    '''
+    Run statements in dependency order, each ready statement on the next idle connection.
+    Every statement is committed on its own; after a failure no new statements are started and
+    the first error is raised once the running ones finish.
+    :param tasks: Dict of task name to (statement, names of the tasks it depends on).
+    :param run: Function run(cur, name, statement) executing one statement.
+    :param connections: Open connections, as many statements run at once.
+    :return: Dict of task name to (start, end) seconds since the start of the run.
+    '''
+    get_task_order(tasks)
+
+    idle = queue.Queue()
+    for conn in connections:
+        idle.put(conn)
+    timings = {}
+    start = time.perf_counter()
+
+    waiting = dict((name, set(dependencies)) for name, (statement, dependencies) in tasks.items())
+    running = {}
+    error = None
+    with ThreadPoolExecutor(len(connections)) as executor:
+        def submit(name):
+            return executor.submit(execute_task, idle, run, name, tasks[name][0], start, timings)
+
+        while waiting or running:
+            if error is None:
+                submit_ready(waiting, running, submit)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            error = complete_done(done, waiting, running, error)
+
+    if error is not None:
+        raise error
+    return timings
+
+
+def get_critical_path(tasks, timings):
+    '''
+    Find the chain of dependent tasks with the longest total run time, which bounds the run time
+    however many statements run at once.
+    :param tasks: Dict of task name to (statement, names of the tasks it depends on).
+    :param timings: Dict of task name to (start, end) seconds, as returned by run_dag.
+    :return: (list of task names along the path, total seconds) tuple.
+    '''
+    longest = {}
+    for name in get_task_order(tasks):
+        seconds = timings[name][1] - timings[name][0]
+        previous = max(tasks[name][1], key=lambda dependency: longest[dependency][1], default=None)
+        path, total = longest[previous] if previous else ([], 0.0)
+        longest[name] = (path + [name], total + seconds)
+    return max(longest.values(), key=lambda path: path[1], default=([], 0.0))
@@ -1,47 +1,405 @@
+import argparse
 import configparser
+import difflib
+import glob
+import hashlib
+import json
+import os
+import re
+from datetime import datetime
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from sql_queries import copy_table_dag, insert_table_dag, copy_count_select, merge_table_queries, \
+    maintained_tables, table_maintenance_select, table_analyze, table_vacuum_sort, critical_queries, LOG_DATA, \
+    SONG_DATA, STAGING_MANIFESTS, staging_events_new_copy, staging_songs_copy, staging_events_truncate, \
+    staging_songs_truncate, load_state_table_create, load_state_select, load_state_delete, load_state_insert, \
+    load_state_seed_queries
+from dag import run_dag, get_critical_path
+from pack_staging import get_s3_client, split_s3_url, strip_quotes
+from src.instrumentation.metrics import metrics, PROJECT_DIR
+from src.instrumentation.db import CountingCursor
 
-def load_staging_tables(cur, conn):
+# statements run at once, keep it below the slots of the WLM queue of the ETL user
+CONCURRENCY = 4
+
+# ANALYZE tables with more than this percent of rows changed since their last ANALYZE, like analyze_threshold_percent
+ANALYZE_THRESHOLD = 10.0
+
+# VACUUM SORT ONLY tables with more than this percent of unsorted rows
+VACUUM_THRESHOLD = 5.0
+
+# EXPLAIN output of critical_queries, one JSON file per run
+PLANS_DIR = os.environ.get('SPARKIFY_PLANS_DIR', str(PROJECT_DIR / 'reports' / 'plans'))
+
+# plan steps moving rows between nodes, appearing in a critical query they are reported as a regression
+REDISTRIBUTION_STEPS = ('DS_BCAST_INNER', 'DS_DIST_ALL_INNER', 'DS_DIST_BOTH', 'DS_DIST_INNER', 'DS_DIST_OUTER')
+
+# estimated cost growth of a critical query reported as a regression
+COST_REGRESSION = 2.0
+
+
+def report_critical_path(tasks, timings):
     '''
-    Copy data from S3 to Redshift staging tables.
+    Print the chain of dependent statements that bounded a concurrent step.
+    :param tasks: Dict of statement name to (statement, dependencies) run by run_dag.
+    :param timings: Dict of statement name to (start, end) seconds returned by run_dag.
+    :return: No values returned.
+    '''
+    path, seconds = get_critical_path(tasks, timings)
+    wall = max(end for start, end in timings.values()) if timings else 0.0
+    print('Critical path: {} ({:.3f}s of {:.3f}s).'.format(' -> '.join(path), seconds, wall))
+
+
+def copy_table(cur, name, query):
+    '''
+    Copy one staging table and count the loaded rows.
     :param cur: Cursor used to execute query.
-    :param conn: Connection used to commit changes.
+    :param name: Staging table name.
+    :param query: COPY statement.
     :return: No values returned.
     '''
-    for query in copy_table_queries:
+    with metrics.stage('load_staging_tables.' + name):
         cur.execute(query)
-        conn.commit()
+        cur.execute(copy_count_select)
+        metrics.add(rows_written=cur.fetchone()[0])
 
 
-def insert_tables(cur, conn):
+def insert_table(cur, name, query):
+    '''
+    Run one insert into a fact or dimensional table and count the inserted rows.
+    :param cur: Cursor used to execute query.
+    :param name: Table name.
+    :param query: INSERT statement.
+    :return: No values returned.
+    '''
+    with metrics.stage('insert_tables.' + name):
+        cur.execute(query)
+        metrics.add(rows_written=max(cur.rowcount, 0))
+
+
+@metrics.instrument()
+def load_staging_tables(cur, conn, connections=None):
+    '''
+    Copy data from S3 to Redshift staging tables, from the pack_staging.py manifests when PACKED_DATA is set.
+    The COPY statements run concurrently, one per connection.
+    :param cur: Cursor used to execute query.
+    :param conn: Connection used to commit changes.
+    :param connections: Connections to run the statements on, only conn when omitted.
+    :return: No values returned.
+    '''
+    timings = run_dag(copy_table_dag, copy_table, connections or [conn])
+    report_critical_path(copy_table_dag, timings)
+
+
+@metrics.instrument()
+def insert_tables(cur, conn, connections=None):
     '''
     Insert data into Redshift dimensional tables from staging tables.
+    Inserts run concurrently, one per connection, once the tables they read from are loaded.
     :param cur: Cursor used to execute query.
     :param conn: Connection used to commit changes.
+    :param connections: Connections to run the statements on, only conn when omitted.
     :return: No values returned.
     '''
-    for query in insert_table_queries:
+    timings = run_dag(insert_table_dag, insert_table, connections or [conn])
+    report_critical_path(insert_table_dag, timings)
+
+
+def list_objects(url, s3):
+    '''
+    List the objects under an S3 prefix, like the COPY of the prefix reads them.
+    :param url: s3:// prefix.
+    :param s3: S3 client.
+    :return: List of (URL, size in bytes, last modified epoch milliseconds) tuples.
+    '''
+    bucket, prefix = split_s3_url(url)
+    objects = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects.append(('s3://{}/{}'.format(bucket, obj['Key']), obj['Size'],
+                            int(obj['LastModified'].timestamp() * 1000)))
+    return objects
+
+
+def get_listing_version(objects):
+    '''
+    Fingerprint a listing, it changes when an object is added, removed or rewritten.
+    :param objects: List of (URL, size, last modified) tuples of list_objects.
+    :return: Signed 64 bit version, stored as a load_state BIGINT.
+    '''
+    digest = hashlib.sha1(json.dumps(sorted(objects)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def get_source_state(log_objects, song_objects):
+    '''
+    Compute the load_state values recording which source objects a load staged.
+    :param log_objects: LOG_DATA listing.
+    :param song_objects: SONG_DATA listing.
+    :return: Dict of watermark name to value.
+    '''
+    state = {'song_data_version': get_listing_version(song_objects)}
+    if log_objects:
+        state['log_data_modified'] = max(modified for url, size, modified in log_objects)
+    return state
+
+
+def list_sources(s3):
+    '''
+    List LOG_DATA and SONG_DATA, before loading them so objects added during the load are staged again by the
+    next incremental load, where their events up to the ts watermark are dropped.
+    :param s3: S3 client.
+    :return: (LOG_DATA listing, SONG_DATA listing) tuple of list_objects.
+    '''
+    return list_objects(strip_quotes(LOG_DATA), s3), list_objects(strip_quotes(SONG_DATA), s3)
+
+
+def set_load_state(cur, state):
+    '''
+    Store load_state values, in the transaction of cur.
+    :param cur: Cursor used to execute query.
+    :param state: Dict of watermark name to value.
+    :return: No values returned.
+    '''
+    for name, value in sorted(state.items()):
+        cur.execute(load_state_delete, (name,))
+        cur.execute(load_state_insert, (name, value))
+
+
+@metrics.instrument()
+def update_load_state(cur, conn, state):
+    '''
+    Set the watermarks after a full load, so the next incremental load neither merges its events again nor
+    stages its objects again: ts is the latest staged event, the source values come from get_source_state.
+    :param cur: Cursor used to execute query.
+    :param conn: Connection used to commit changes.
+    :param state: Dict of source watermark name to value.
+    :return: No values returned.
+    '''
+    for query in load_state_seed_queries:
         cur.execute(query)
-        conn.commit()
+    set_load_state(cur, state)
+    conn.commit()
+
+
+@metrics.instrument()
+def load_new_staging_tables(cur, conn, connections=None, s3=None, manifests=STAGING_MANIFESTS):
+    '''
+    Stage only what changed since the previous load: staging_events gets the log objects modified after the
+    log_data_modified watermark, through a manifest written under manifests, and staging_songs is reloaded
+    only when the song_data listing differs from song_data_version, otherwise it keeps the songs of the
+    previous load. Runs before merge_tables, which stores the returned watermarks.
+    :param cur: Cursor used to execute query.
+    :param conn: Connection used to commit changes.
+    :param connections: Connections to run the COPY statements on, only conn when omitted.
+    :param s3: S3 client listing the sources and storing the manifest.
+    :param manifests: s3:// prefix of the manifest.
+    :return: Dict of watermark name to value for merge_tables.
+    '''
+    cur.execute(load_state_table_create)
+    cur.execute(load_state_select)
+    previous = dict(cur.fetchall())
+    conn.commit()
+
+    log_objects, song_objects = list_sources(s3)
+    state = get_source_state(log_objects, song_objects)
+    new_log_objects = [url for url, size, modified in log_objects
+                       if modified > previous.get('log_data_modified', -1)]
+
+    tasks = {}
+    cur.execute(staging_events_truncate)
+    if new_log_objects:
+        bucket, key = split_s3_url(manifests + '/log_data-new.manifest')
+        manifest = {'entries': [{'url': url, 'mandatory': True} for url in new_log_objects]}
+        s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+        tasks['staging_events'] = (staging_events_new_copy.format('s3://{}/{}'.format(bucket, key)), [])
+    if state['song_data_version'] != previous.get('song_data_version'):
+        cur.execute(staging_songs_truncate)
+        tasks['staging_songs'] = (staging_songs_copy, [])
+    conn.commit()
+    print('Staging {} of {} log objects, song_data {}.'.format(
+        len(new_log_objects), len(log_objects), 'changed' if 'staging_songs' in tasks else 'unchanged'))
+
+    if tasks:
+        timings = run_dag(tasks, copy_table, connections or [conn])
+        report_critical_path(tasks, timings)
+    return state
+
+
+@metrics.instrument()
+def merge_tables(cur, conn, state=None):
+    '''
+    Merge the staged events newer than the load_state watermark into the fact and dimensional tables.
+    Users of the new events are replaced by their latest event, missing songs, artists and time rows are
+    added, and the watermarks move to the latest staged event and to state, all in one transaction.
+    :param cur: Cursor used to execute query.
+    :param conn: Connection used to commit changes.
+    :param state: Dict of source watermark name to value returned by load_new_staging_tables.
+    :return: No values returned.
+    '''
+    for query in merge_table_queries:
+        cur.execute(query)
+        if query.lstrip().startswith('INSERT'):
+            metrics.add(rows_written=max(cur.rowcount, 0))
+    set_load_state(cur, state or {})
+    conn.commit()
+
+
+@metrics.instrument()
+def maintain_tables(cur, conn, analyze_threshold=ANALYZE_THRESHOLD, vacuum_threshold=VACUUM_THRESHOLD):
+    '''
+    ANALYZE the fact and dimensional tables whose statistics are off by more than analyze_threshold percent and
+    VACUUM SORT ONLY those with more than vacuum_threshold percent unsorted rows, according to svv_table_info.
+    :param cur: Cursor used to execute query.
+    :param conn: Connection used to commit changes.
+    :param analyze_threshold: Percent of changed rows above which a table is analyzed.
+    :param vacuum_threshold: Percent of unsorted rows above which a table is vacuumed.
+    :return: List of statements run.
+    '''
+    cur.execute(table_maintenance_select)
+    # empty tables are not listed and need no maintenance
+    stats = dict((table, (stats_off, unsorted)) for table, stats_off, unsorted in cur.fetchall())
+
+    statements = []
+    for table in maintained_tables:
+        stats_off, unsorted = stats.get(table, (None, None))
+        if stats_off is not None and stats_off > analyze_threshold:
+            statements.append(table_analyze.format(table))
+        if unsorted is not None and unsorted > vacuum_threshold:
+            statements.append(table_vacuum_sort.format(table))
+
+    # VACUUM cannot run inside a transaction block
+    conn.commit()
+    conn.autocommit = True
+    try:
+        for statement in statements:
+            print(statement)
+            cur.execute(statement)
+    finally:
+        conn.autocommit = False
+    return statements
+
+
+def get_plan_cost(plan):
+    '''
+    Read the estimated total cost of a plan from its top step, e.g. (cost=0.00..1234.56 rows=10 width=8).
+    :param plan: List of EXPLAIN output lines.
+    :return: Total cost, None when not found.
+    '''
+    match = re.search(r'cost=[\d.]+\.\.([\d.]+)', plan[0]) if plan else None
+    return float(match.group(1)) if match else None
+
+
+def compare_plans(previous, plans):
+    '''
+    Compare the plans of the critical queries with those of the previous run. Costs and row estimates are
+    ignored when comparing the steps, as they follow the data.
+    :param previous: Dict of query name to EXPLAIN output lines of the previous run.
+    :param plans: Dict of query name to EXPLAIN output lines of this run.
+    :return: List of differences, empty when no plan regressed.
+    '''
+    differences = []
+    for name, plan in plans.items():
+        if name not in previous:
+            continue
+        steps = [re.sub(r'\s*\(cost=[^)]*\)', '', line).rstrip() for line in plan]
+        previous_steps = [re.sub(r'\s*\(cost=[^)]*\)', '', line).rstrip() for line in previous[name]]
+        if steps != previous_steps:
+            differences.append('{}: plan changed\n{}'.format(name, '\n'.join(
+                difflib.unified_diff(previous_steps, steps, 'previous', 'current', lineterm=''))))
+
+        redistribution = [step for step in REDISTRIBUTION_STEPS
+                          if any(step in line for line in plan) and not any(step in line for line in previous[name])]
+        if redistribution:
+            differences.append('{}: new redistribution {}'.format(name, ', '.join(redistribution)))
+
+        cost, previous_cost = get_plan_cost(plan), get_plan_cost(previous[name])
+        if cost and previous_cost and cost > COST_REGRESSION * previous_cost:
+            differences.append('{}: estimated cost rose from {} to {}'.format(name, previous_cost, cost))
+    return differences
+
+
+@metrics.instrument()
+def capture_plans(cur, job='cloud_warehouse_aws_etl', plans_dir=None):
+    '''
+    EXPLAIN the critical queries, store the plans in <plans_dir>/<job>-<time>.json and print how they differ
+    from the plans of the previous run of the job.
+    :param cur: Cursor used to execute query.
+    :param job: Job name the plans are stored under.
+    :param plans_dir: Directory of the plan files, PLANS_DIR when omitted.
+    :return: (path of the plans file, list of differences) tuple.
+    '''
+    plans_dir = plans_dir or PLANS_DIR
+    plans = {}
+    for name, query in critical_queries.items():
+        cur.execute('EXPLAIN ' + query)
+        plans[name] = [row[0] for row in cur.fetchall()]
+
+    differences = []
+    previous_paths = sorted(glob.glob(os.path.join(plans_dir, job + '-*.json')))
+    if previous_paths:
+        with open(previous_paths[-1]) as f:
+            differences = compare_plans(json.load(f)['plans'], plans)
+        for difference in differences:
+            print(difference)
+
+    os.makedirs(plans_dir, exist_ok=True)
+    captured_at = datetime.now()
+    path = os.path.join(plans_dir, '{}-{:%Y%m%d-%H%M%S}.json'.format(job, captured_at))
+    with open(path, 'w') as f:
+        json.dump({'job': job, 'captured_at': captured_at.isoformat(), 'plans': plans}, f, indent=2)
+    return path, differences
 
 
 def main():
     '''
     Main function loads staging tables from S3 and then inserts data into dimensional model tables according to
-    configuration stored in 'dwh.cfg' file.
+    configuration stored in 'dwh.cfg' file. With --incremental only the log objects added since the previous
+    run are staged, song_data only when it changed, and only events after the watermark are merged.
+    The loaded tables are then analyzed and vacuumed as needed and the plans of the critical queries are captured.
     :return: No return values.
     '''
+    parser = argparse.ArgumentParser(description='Load the S3 data into the Redshift star schema.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='stage and merge only the data added since the previous run instead of inserting all')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help='statements run at once on separate connections (default: {})'.format(CONCURRENCY))
+    parser.add_argument('--analyze-threshold', type=float, default=ANALYZE_THRESHOLD,
+                        help='ANALYZE tables with more percent of rows changed (default: {})'.format(ANALYZE_THRESHOLD))
+    parser.add_argument('--vacuum-threshold', type=float, default=VACUUM_THRESHOLD,
+                        help='VACUUM SORT ONLY tables with more percent of unsorted rows (default: {})'.format(
+                            VACUUM_THRESHOLD))
+    parser.add_argument('--skip-maintenance', action='store_true',
+                        help='skip ANALYZE, VACUUM and the plan capture after the load')
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    if args.incremental and not STAGING_MANIFESTS:
+        parser.error('--incremental writes a manifest of the new log objects, set STAGING_MANIFESTS in dwh.cfg')
+    s3 = get_s3_client(config)
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    dsn = "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
+    connections = [psycopg2.connect(dsn, cursor_factory=CountingCursor) for _ in range(max(1, args.concurrency))]
+    conn = connections[0]
     cur = conn.cursor()
     
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    if args.incremental:
+        state = load_new_staging_tables(cur, conn, connections, s3)
+        merge_tables(cur, conn, state)
+    else:
+        state = get_source_state(*list_sources(s3))
+        load_staging_tables(cur, conn, connections)
+        insert_tables(cur, conn, connections)
+        update_load_state(cur, conn, state)
+
+    if not args.skip_maintenance:
+        maintain_tables(cur, conn, args.analyze_threshold, args.vacuum_threshold)
+        print('Plans written to {}.'.format(capture_plans(cur)[0]))
+
+    for connection in connections:
+        connection.close()
 
-    conn.close()
+    print('Metrics written to {} and {}.'.format(*metrics.write('cloud_warehouse_aws_etl')))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+import argparse
+import collections
+import configparser
+import glob
+import gzip
+import heapq
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from sql_queries import slice_count_select
+from src.instrumentation.metrics import metrics
+
+# uncompressed bytes per packed file, parts are added in multiples of the slice count
+PART_SIZE = 256 * 1024 * 1024
+
+# threads reading input files and writing parts
+IO_THREADS = 16
+
+# input files read ahead of the gzip writers over all parts, memory is bounded to this many files
+PREFETCH_FILES = 64
+
+
+def strip_quotes(value):
+    '''
+    Remove the SQL quotes around a dwh.cfg S3 path.
+    :param value: Config value, e.g. 's3://udacity-dend/log_data' in single quotes.
+    :return: The unquoted value.
+    '''
+    return value.strip().strip("'")
+
+
+def get_s3_client(config, endpoint_url=None):
+    '''
+    Create an S3 client with the AWS credentials in dwh.cfg.
+    :param config: ConfigParser holding dwh.cfg.
+    :param endpoint_url: Optional S3 compatible endpoint, e.g. a local stand-in.
+    :return: boto3 S3 client.
+    '''
+    import boto3
+
+    return boto3.client('s3',
+                        region_name=config.get('AWS', 'REGION_NAME', fallback=None),
+                        aws_access_key_id=config.get('AWS', 'KEY', fallback=None),
+                        aws_secret_access_key=config.get('AWS', 'SECRET', fallback=None),
+                        endpoint_url=endpoint_url)
+
+
+def split_s3_url(url):
+    '''
+    Split an S3 URL into bucket and key.
+    :param url: URL like s3://bucket/key.
+    :return: (bucket, key) tuple.
+    '''
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def list_files(source, s3=None):
+    '''
+    List the JSON files under a local directory or S3 prefix.
+    :param source: Local directory or s3:// prefix.
+    :param s3: S3 client, needed for S3 prefixes.
+    :return: List of (path or URL, size in bytes) tuples.
+    '''
+    if not source.startswith('s3://'):
+        files = glob.glob(os.path.join(source, '**', '*.json'), recursive=True)
+        return [(f, os.path.getsize(f)) for f in sorted(files)]
+
+    bucket, prefix = split_s3_url(source)
+    files = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json'):
+                files.append(('s3://{}/{}'.format(bucket, obj['Key']), obj['Size']))
+    return files
+
+
+def read_file(url, s3=None):
+    '''
+    Read a local or S3 file.
+    :param url: Path or s3:// URL.
+    :param s3: S3 client, needed for S3 URLs.
+    :return: File contents as bytes.
+    '''
+    if not url.startswith('s3://'):
+        with open(url, 'rb') as f:
+            return f.read()
+    bucket, key = split_s3_url(url)
+    return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def write_file(url, path, s3=None):
+    '''
+    Store a local file at a local path or S3 URL.
+    :param url: Destination path or s3:// URL.
+    :param path: Local file to store.
+    :param s3: S3 client, needed for S3 URLs.
+    :return: No return value.
+    '''
+    if not url.startswith('s3://'):
+        os.makedirs(os.path.dirname(url), exist_ok=True)
+        shutil.copyfile(path, url)
+    else:
+        s3.upload_file(path, *split_s3_url(url))
+
+
+def get_part_count(total_bytes, slices, part_size=PART_SIZE):
+    '''
+    Number of packed files, a multiple of the slice count so every slice loads the same amount.
+    :param total_bytes: Uncompressed input size.
+    :param slices: Number of slices of the cluster.
+    :param part_size: Uncompressed bytes per packed file.
+    :return: Number of packed files.
+    '''
+    return slices * max(1, -(-total_bytes // (slices * part_size)))
+
+
+def assign_parts(files, num_parts):
+    '''
+    Spread files over parts of about equal size, largest files first.
+    :param files: List of (path or URL, size) tuples.
+    :param num_parts: Number of parts.
+    :return: List of num_parts lists of paths or URLs.
+    '''
+    parts = [[] for _ in range(num_parts)]
+    heap = [(0, i) for i in range(num_parts)]
+    for url, size in sorted(files, key=lambda f: f[1], reverse=True):
+        part_size, i = heapq.heappop(heap)
+        parts[i].append(url)
+        heapq.heappush(heap, (part_size + size, i))
+    return parts
+
+
+def read_files(files, s3, executor, window):
+    '''
+    Read files in order through the executor, reading ahead only while window has permits.
+    :param files: Paths or URLs of the input files.
+    :param s3: S3 client, needed for S3 paths.
+    :param executor: Thread pool reading the input files.
+    :param window: Semaphore shared by the parts written concurrently, one permit per file read ahead and
+    not yet consumed.
+    :return: Generator of the file contents, in the order of files.
+    '''
+    pending = collections.deque()
+    remaining = iter(files)
+    done = False
+    try:
+        while True:
+            # a part waits for a permit only when it has no read pending, so every part keeps progressing
+            while not done and window.acquire(blocking=not pending):
+                url = next(remaining, None)
+                if url is None:
+                    window.release()
+                    done = True
+                else:
+                    pending.append(executor.submit(read_file, url, s3))
+            if not pending:
+                return
+            yield pending[0].result()
+            pending.popleft()
+            window.release()
+    finally:
+        for future in pending:
+            future.cancel()
+            window.release()
+
+
+def write_part(url, files, s3, executor, window):
+    '''
+    Concatenate JSON files into one gzip compressed file, each file ending with a newline.
+    :param url: Destination path or s3:// URL of the part.
+    :param files: Paths or URLs of the input files.
+    :param s3: S3 client, needed for S3 paths.
+    :param executor: Thread pool reading the input files.
+    :param window: Semaphore bounding the files read ahead, see read_files.
+    :return: Compressed size of the part in bytes.
+    '''
+    with tempfile.NamedTemporaryFile(suffix='.json.gz') as tmp:
+        with gzip.open(tmp, 'wb', compresslevel=6) as gz:
+            for data in read_files(files, s3, executor, window):
+                gz.write(data)
+                if not data.endswith(b'\n'):
+                    gz.write(b'\n')
+        tmp.flush()
+        write_file(url, tmp.name, s3)
+        return os.path.getsize(tmp.name)
+
+
+@metrics.instrument()
+def pack_files(source, output, name, slices, part_size=PART_SIZE, s3=None, threads=IO_THREADS,
+               prefetch=PREFETCH_FILES):
+    '''
+    Pack the JSON files under source into gzip files sized to a multiple of the cluster slices and
+    write a COPY manifest listing them.
+    :param source: Local directory or s3:// prefix of the input files.
+    :param output: Local directory or s3:// prefix to write to.
+    :param name: Data set name, parts go to <output>/<name>/ and the manifest to <output>/<name>.manifest.
+    :param slices: Number of slices of the cluster.
+    :param part_size: Uncompressed bytes per packed file.
+    :param s3: S3 client, needed for S3 paths.
+    :param threads: Number of threads reading input files.
+    :param prefetch: Number of input files read ahead of the writers of all parts.
+    :return: URL of the manifest.
+    '''
+    output = output.rstrip('/')
+    if not output.startswith('s3://'):
+        output = os.path.abspath(output)
+
+    files = list_files(source, s3)
+    total_bytes = sum(size for _, size in files)
+    parts = [part for part in assign_parts(files, get_part_count(total_bytes, slices, part_size)) if part]
+    print('Packing {} files ({} bytes) from {} into {} parts.'.format(len(files), total_bytes, source, len(parts)))
+
+    urls = ['{}/{}/part-{:05d}.json.gz'.format(output, name, i) for i in range(len(parts))]
+    window = threading.BoundedSemaphore(prefetch)
+    with ThreadPoolExecutor(threads) as read_executor, ThreadPoolExecutor(slices) as part_executor:
+        sizes = list(part_executor.map(lambda args: write_part(args[0], args[1], s3, read_executor, window),
+                                       zip(urls, parts)))
+    metrics.add(rows_read=len(files), rows_written=len(parts), bytes_processed=total_bytes)
+
+    manifest = {'entries': [{'url': url, 'mandatory': True, 'meta': {'content_length': size}}
+                            for url, size in zip(urls, sizes)]}
+    manifest_url = '{}/{}.manifest'.format(output, name)
+    with tempfile.NamedTemporaryFile('w', suffix='.manifest') as tmp:
+        json.dump(manifest, tmp, indent=2)
+        tmp.flush()
+        write_file(manifest_url, tmp.name, s3)
+    print('Wrote {}.'.format(manifest_url))
+    return manifest_url
+
+
+def get_slice_count(cur):
+    '''
+    Query the number of slices of the cluster.
+    :param cur: Cursor used to execute query.
+    :return: Number of slices.
+    '''
+    cur.execute(slice_count_select)
+    return cur.fetchone()[0]
+
+
+def main():
+    '''
+    Main function packs the log and song data configured in 'dwh.cfg' into gzip files and COPY manifests
+    under PACKED_DATA, for etl.py to load them from the manifests. Paths can be overridden to pack local
+    directories or use an S3 stand-in.
+    :return: No return values.
+    '''
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    parser = argparse.ArgumentParser(description='Pack the staging input files for manifest COPY.')
+    parser.add_argument('--log-data', default=strip_quotes(config.get('S3', 'LOG_DATA')),
+                        help='log data directory or s3:// prefix (default: LOG_DATA of dwh.cfg)')
+    parser.add_argument('--song-data', default=strip_quotes(config.get('S3', 'SONG_DATA')),
+                        help='song data directory or s3:// prefix (default: SONG_DATA of dwh.cfg)')
+    parser.add_argument('--output', default=strip_quotes(config.get('S3', 'PACKED_DATA', fallback='')),
+                        help='directory or s3:// prefix of the packed files (default: PACKED_DATA of dwh.cfg)')
+    parser.add_argument('--slices', type=int,
+                        help='number of cluster slices (default: queried from the cluster in dwh.cfg)')
+    parser.add_argument('--part-size', type=int, default=PART_SIZE,
+                        help='uncompressed bytes per packed file (default: {})'.format(PART_SIZE))
+    parser.add_argument('--endpoint-url', help='S3 compatible endpoint to use instead of AWS S3')
+    args = parser.parse_args()
+
+    if not args.output:
+        parser.error('set PACKED_DATA in dwh.cfg or pass --output')
+
+    slices = args.slices
+    if slices is None:
+        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+        slices = get_slice_count(conn.cursor())
+        conn.close()
+
+    s3 = None
+    if any(path.startswith('s3://') for path in (args.log_data, args.song_data, args.output)):
+        s3 = get_s3_client(config, args.endpoint_url)
+
+    pack_files(args.log_data, args.output, 'log_data', slices, args.part_size, s3)
+    pack_files(args.song_data, args.output, 'song_data', slices, args.part_size, s3)
+
+    print('Metrics written to {} and {}.'.format(*metrics.write('cloud_warehouse_aws_pack')))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import connection
+import create_tables
+import etl
+from sql_queries import table_maintenance_select
+from src.instrumentation.db import CountingCursor
+from src.instrumentation.metrics import metrics
+
+DSN = "host=127.0.0.1 dbname=rehearsaldb user=student password=student"
+
+# database the rehearsal database is created from
+ADMIN_DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+
+# Redshift syntax rewritten for Postgres, as (pattern, replacement)
+REWRITES = [
+    # table attributes generated by table_design_ddl
+    (re.compile(r'\)\s*DISTSTYLE\b[^\n]*'), ')'),
+    (re.compile(r'\bIDENTITY\((\d+),\s*(\d+)\)', re.I),
+     r'GENERATED BY DEFAULT AS IDENTITY (START WITH \1 MINVALUE \1 INCREMENT BY \2)'),
+    (re.compile(r'\bextract\(\s*weekday\s+from\b', re.I), 'extract(dow from'),
+    (re.compile(r'^\s*VACUUM\s+SORT\s+ONLY\b', re.I), 'VACUUM'),
+]
+
+# Redshift system view queries replaced by their Postgres counterparts: tables never analyzed are 100 percent
+# off like in svv_table_info, and Postgres tables are never unsorted
+STATEMENTS = {
+    table_maintenance_select: ("""
+        SELECT c.relname,
+               CASE WHEN c.reltuples < 0 THEN 100.0
+                    ELSE 100.0 * s.n_mod_since_analyze / GREATEST(c.reltuples, 1) END,
+               NULL
+        FROM pg_class AS c
+        JOIN pg_stat_user_tables AS s ON s.relid = c.oid
+        WHERE s.schemaname = 'public'
+    """),
+}
+
+COPY_PATTERN = re.compile(r"^\s*copy\s+(\w+)\s+from\s+'([^']+)'(.*)$", re.I | re.S)
+JSON_OPTION_PATTERN = re.compile(r"\bjson\s+'([^']+)'", re.I)
+LAST_COPY_COUNT_PATTERN = re.compile(r'^\s*SELECT\s+pg_last_copy_count\(\)\s*;?\s*$', re.I)
+LABEL_PATTERN = re.compile(r'^\s*(INSERT\s+INTO|DELETE\s+FROM|UPDATE|CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|'
+                           r'DROP\s+TABLE(?:\s+IF\s+EXISTS)?|TRUNCATE|COPY|SELECT|ANALYZE|'
+                           r'VACUUM(?:\s+SORT\s+ONLY)?|EXPLAIN)\s+(\w+)?', re.I)
+JSONPATH_PATTERN = re.compile(r"\['([^']*)'\]|\.(\w+)")
+
+TEXT_TYPES = ('character varying', 'text', 'character')
+
+# statement label -> [calls, seconds, max seconds], shared by the threads of dag.run_dag
+statement_timings = {}
+statement_lock = threading.Lock()
+
+
+def get_statement_label(query):
+    '''
+    Name a statement by its verb and table, e.g. 'INSERT INTO songplays'.
+    :param query: SQL statement.
+    :return: Statement label.
+    '''
+    match = LABEL_PATTERN.match(query)
+    if not match:
+        return query.strip().split(None, 1)[0].upper() if query.strip() else ''
+    verb = re.sub(r'\s+', ' ', match.group(1).upper()).replace(' IF NOT EXISTS', '').replace(' IF EXISTS', '')
+    return '{} {}'.format(verb, match.group(2)) if match.group(2) and verb not in ('SELECT', 'EXPLAIN') else verb
+
+
+def translate(query):
+    '''
+    Rewrite the Redshift specific syntax of a statement for Postgres.
+    :param query: Redshift SQL statement.
+    :return: Postgres SQL statement.
+    '''
+    for pattern, replacement in REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def get_local_path(url, data_dir):
+    '''
+    Map an S3 URL to the local rehearsal data, s3://<bucket>/<key> is read from <data_dir>/<key>.
+    :param url: s3:// URL or local path.
+    :param data_dir: Local directory standing in for the buckets.
+    :return: Local path.
+    '''
+    if not url.startswith('s3://'):
+        return url
+    return os.path.join(data_dir, url[len('s3://'):].partition('/')[2])
+
+
+def list_local_files(prefix):
+    '''
+    List the local files whose path starts with prefix, like the keys under an S3 prefix.
+    :param prefix: Local path prefix.
+    :return: Sorted list of file paths.
+    '''
+    directory = prefix if os.path.isdir(prefix) else os.path.dirname(prefix) or '.'
+    files = []
+    for root, dirs, names in os.walk(directory):
+        files.extend(os.path.join(root, name) for name in names if os.path.join(root, name).startswith(prefix))
+    return sorted(files)
+
+
+class LocalS3(object):
+    '''
+    Stand-in for the boto3 S3 client calls of etl.py, keys are files under data_dir like for get_local_path.
+    '''
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        contents = []
+        for path in list_local_files(os.path.join(self.data_dir, Prefix)):
+            contents.append({'Key': os.path.relpath(path, self.data_dir), 'Size': os.path.getsize(path),
+                             'LastModified': datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)})
+        yield {'Contents': contents}
+
+    def put_object(self, Bucket, Key, Body):
+        path = os.path.join(self.data_dir, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+
+
+def read_json_objects(path):
+    '''
+    Read the JSON objects of a file, one object per file or per line, gzip compressed or not.
+    :param path: Local file path.
+    :return: Generator of parsed JSON objects.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    text = data.decode('utf-8')
+    decoder = json.JSONDecoder()
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position == len(text):
+            return
+        value, position = decoder.raw_decode(text, position)
+        yield value
+
+
+def get_jsonpath_getter(jsonpath):
+    '''
+    Compile a jsonpaths expression like $['firstName'] or $.song.title.
+    :param jsonpath: JSONPath expression of a jsonpaths file.
+    :return: Function returning the value at the path of a JSON object, None when missing.
+    '''
+    keys = [quoted if quoted else dotted for quoted, dotted in JSONPATH_PATTERN.findall(jsonpath)]
+
+    def get(record):
+        for key in keys:
+            if not isinstance(record, dict) or key not in record:
+                return None
+            record = record[key]
+        return record
+    return get
+
+
+def to_copy_text(value, data_type):
+    '''
+    Format a JSON value as a field of COPY text format, converting it like Redshift does for the column type.
+    :param value: JSON value.
+    :param data_type: information_schema data type of the column.
+    :return: Escaped COPY text field.
+    '''
+    if value is None or (value == '' and data_type not in TEXT_TYPES):
+        return '\\N'
+    if isinstance(value, bool):
+        value = str(value).lower() if data_type in TEXT_TYPES else int(value)
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class RehearsalConnection(connection):
+    '''
+    Connection keeping the row count of its last emulated COPY, for pg_last_copy_count().
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(RehearsalConnection, self).__init__(*args, **kwargs)
+        self.last_copy_count = -1
+        self.data_dir = '.'
+
+
+class RehearsalCursor(CountingCursor):
+    '''
+    Cursor running the Redshift statements of sql_queries.py on Postgres and timing each one:
+    DDL and queries are rewritten, COPY from S3 is emulated from local files.
+    '''
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            copy = COPY_PATTERN.match(query)
+            if copy:
+                self.copy_json(copy.group(1), copy.group(2), copy.group(3))
+            elif LAST_COPY_COUNT_PATTERN.match(query):
+                super(RehearsalCursor, self).execute('SELECT %s', (self.connection.last_copy_count,))
+            else:
+                super(RehearsalCursor, self).execute(translate(STATEMENTS.get(query, query)), vars)
+        finally:
+            record_statement(get_statement_label(query), time.perf_counter() - start)
+
+    def copy_json(self, table, source, options):
+        '''
+        Emulate COPY ... FROM 's3://...' JSON with COPY FROM STDIN of the matching local files.
+        :param table: Target table.
+        :param source: S3 prefix, or manifest URL with the MANIFEST option.
+        :param options: Rest of the COPY statement.
+        :return: No values returned.
+        '''
+        data_dir = self.connection.data_dir
+        path = get_local_path(source, data_dir)
+        if re.search(r'\bmanifest\b', options, re.I):
+            with open(path) as f:
+                files = [get_local_path(entry['url'], data_dir) for entry in json.load(f)['entries']]
+        else:
+            files = list_local_files(path)
+
+        super(RehearsalCursor, self).execute(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position", (table,))
+        columns = self.fetchall()
+
+        json_option = JSON_OPTION_PATTERN.search(options)
+        json_option = json_option.group(1) if json_option else 'auto'
+        jsonpaths = get_local_path(json_option, data_dir)
+        if json_option.lower() not in ('auto', 'auto ignorecase') and os.path.exists(jsonpaths):
+            with open(jsonpaths) as f:
+                getters = [get_jsonpath_getter(jsonpath) for jsonpath in json.load(f)['jsonpaths']]
+        else:
+            if json_option.lower() not in ('auto', 'auto ignorecase'):
+                print('{} not found, loading {} with auto ignorecase.'.format(jsonpaths, table))
+            ignorecase = json_option.lower() != 'auto'
+            getters = [(lambda name: lambda record: next(
+                (value for key, value in record.items() if (key.lower() if ignorecase else key) == name), None))(name)
+                for name, data_type in columns]
+
+        buffer = io.StringIO()
+        count = 0
+        for path in files:
+            for record in read_json_objects(path):
+                buffer.write('\t'.join(to_copy_text(get(record), data_type)
+                                       for get, (name, data_type) in zip(getters, columns)))
+                buffer.write('\n')
+                count += 1
+        buffer.seek(0)
+        self.copy_expert(sql.SQL('COPY {} FROM STDIN').format(sql.Identifier(table)).as_string(self), buffer)
+        self.connection.last_copy_count = count
+
+
+def record_statement(label, seconds):
+    '''
+    Add the run time of one statement to statement_timings.
+    :param label: Statement label.
+    :param seconds: Run time.
+    :return: No values returned.
+    '''
+    with statement_lock:
+        timing = statement_timings.setdefault(label, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+
+def report_statements():
+    '''
+    Print the statement timings, slowest first, and add them to the run metrics as statement.<label> stages.
+    :return: No values returned.
+    '''
+    with statement_lock:
+        timings = sorted(statement_timings.items(), key=lambda item: item[1][1], reverse=True)
+    print('{:>10} {:>6}  {}'.format('seconds', 'calls', 'statement'))
+    for label, (calls, seconds, max_seconds) in timings:
+        print('{:>10.3f} {:>6}  {}'.format(seconds, calls, label))
+    metrics.merge(dict(('statement.' + label, {'calls': calls, 'seconds': seconds, 'max_seconds': max_seconds})
+                       for label, (calls, seconds, max_seconds) in timings))
+
+
+def connect(dsn, data_dir):
+    '''
+    Open a rehearsal connection, in UTC like Redshift.
+    :param dsn: Connection string of the local Postgres database.
+    :param data_dir: Local directory standing in for the S3 buckets.
+    :return: RehearsalConnection using RehearsalCursor.
+    '''
+    conn = psycopg2.connect(dsn, connection_factory=RehearsalConnection, cursor_factory=RehearsalCursor,
+                            options='-c timezone=UTC')
+    conn.data_dir = data_dir
+    return conn
+
+
+def create_database(dsn=DSN, admin_dsn=ADMIN_DSN):
+    '''
+    Create the rehearsal database when it does not exist.
+    :param dsn: Connection string of the rehearsal database.
+    :param admin_dsn: Connection string of a database to create it from.
+    :return: No values returned.
+    '''
+    dbname = psycopg2.extensions.parse_dsn(dsn)['dbname']
+    conn = psycopg2.connect(admin_dsn)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (dbname,))
+    if not cur.fetchone():
+        cur.execute(sql.SQL("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0").format(
+            sql.Identifier(dbname)))
+    conn.close()
+
+
+def rehearse(data_dir, dsn=DSN, incremental=False, concurrency=etl.CONCURRENCY):
+    '''
+    Run the create_tables.py and etl.py workflow against local Postgres, including the maintenance and the
+    plan capture after the load.
+    :param data_dir: Local directory standing in for the S3 buckets, e.g. holding log_data and song_data.
+    :param dsn: Connection string of the rehearsal database.
+    :param incremental: Run the incremental merge instead of recreating the tables and inserting, its manifest
+    is written to <data_dir>/manifests.
+    :param concurrency: Statements run at once on separate connections.
+    :return: Dict of table name to row count.
+    '''
+    create_database(dsn)
+    connections = [connect(dsn, data_dir) for _ in range(max(1, concurrency))]
+    conn = connections[0]
+    cur = conn.cursor()
+    s3 = LocalS3(data_dir)
+
+    try:
+        if incremental:
+            # tables of the previous rehearsal are kept, only the new objects are staged and their events merged
+            create_tables.create_tables(cur, conn)
+            state = etl.load_new_staging_tables(cur, conn, connections, s3, 's3://rehearsal/manifests')
+            etl.merge_tables(cur, conn, state)
+        else:
+            create_tables.drop_tables(cur, conn)
+            create_tables.create_tables(cur, conn)
+            state = etl.get_source_state(*etl.list_sources(s3))
+            etl.load_staging_tables(cur, conn, connections)
+            etl.insert_tables(cur, conn, connections)
+            etl.update_load_state(cur, conn, state)
+
+        etl.maintain_tables(cur, conn)
+        plans_path, differences = etl.capture_plans(cur, 'cloud_warehouse_aws_rehearsal')
+        print('Plans written to {}.'.format(plans_path))
+
+        counts = {}
+        for table in ('staging_events', 'staging_songs', 'songplays', 'users', 'songs', 'artists', 'time'):
+            cur.execute('SELECT COUNT(*) FROM {}'.format(table))
+            counts[table] = cur.fetchone()[0]
+        conn.commit()
+    finally:
+        for rehearsal_conn in connections:
+            rehearsal_conn.close()
+    return counts
+
+
+def main():
+    '''
+    Main function rehearses the Redshift load on local Postgres: the DDL generated for the cluster is checked,
+    the tables are created and loaded from local copies of the S3 data, and every statement is timed.
+    :return: No return values.
+    '''
+    parser = argparse.ArgumentParser(description='Rehearse the Redshift load on a local Postgres database.')
+    parser.add_argument('data_dir', help='directory standing in for the S3 buckets, s3://<bucket>/<key> is read '
+                                         'from <data_dir>/<key>')
+    parser.add_argument('--dsn', default=DSN, help='rehearsal database (default: {})'.format(DSN))
+    parser.add_argument('--incremental', action='store_true', help='run the incremental merge of etl.py')
+    parser.add_argument('--concurrency', type=int, default=etl.CONCURRENCY,
+                        help='statements run at once on separate connections (default: {})'.format(etl.CONCURRENCY))
+    args = parser.parse_args()
+
+    problems = create_tables.check_table_design()
+    if problems:
+        print('\n'.join(problems))
+
+    counts = rehearse(os.path.abspath(args.data_dir), args.dsn, args.incremental, args.concurrency)
+    for table, count in counts.items():
+        print('{}: {} rows'.format(table, count))
+    report_statements()
+
+    print('Metrics written to {} and {}.'.format(*metrics.write('cloud_warehouse_aws_rehearsal')))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,14 @@ LOG_DATA = config.get("S3", "LOG_DATA")
 LOG_JSONPATH = config.get("S3", "LOG_JSONPATH")
 SONG_DATA = config.get("S3", "SONG_DATA")
 
+# packed input of pack_staging.py, staging tables are loaded from its manifests when set
+PACKED_DATA = config.get("S3", "PACKED_DATA", fallback="").strip().strip("'").rstrip('/')
+LOG_MANIFEST = "'{}/log_data.manifest'".format(PACKED_DATA)
+SONG_MANIFEST = "'{}/song_data.manifest'".format(PACKED_DATA)
+
+# prefix the incremental load writes the manifest of the new log objects to
+STAGING_MANIFESTS = config.get("S3", "STAGING_MANIFESTS", fallback="").strip().strip("'").rstrip('/')
+
 # DROP TABLES
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
@@ -19,6 +27,40 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+load_state_table_drop = "DROP TABLE IF EXISTS load_state"
+
+# PHYSICAL DESIGN
+
+# users, songs and artists are small and copied to every node, so songplays joins them
+# without redistribution. songplays and time grow with the events: both are distributed
+# on their join column start_time and sorted on it for time range filters. The staging
+# tables are distributed on the song title the songplays insert joins them on.
+TABLE_DESIGN = {
+    'staging_events': {'diststyle': 'KEY', 'distkey': 'song'},
+    'staging_songs': {'diststyle': 'KEY', 'distkey': 'title'},
+    'songplays': {'diststyle': 'KEY', 'distkey': 'start_time', 'sortkey': ['start_time']},
+    'users': {'diststyle': 'ALL', 'sortkey': ['user_id']},
+    'songs': {'diststyle': 'ALL', 'sortkey': ['song_id']},
+    'artists': {'diststyle': 'ALL', 'sortkey': ['artist_id']},
+    'time': {'diststyle': 'KEY', 'distkey': 'start_time', 'sortkey': ['start_time']},
+    'load_state': {'diststyle': 'ALL'},
+}
+
+
+def table_design_ddl(table):
+    '''
+    Generate the distribution and sort key attributes of a table from TABLE_DESIGN.
+    :param table: Table name.
+    :return: CREATE TABLE attributes, e.g. 'DISTSTYLE KEY DISTKEY (start_time) COMPOUND SORTKEY (start_time)'.
+    '''
+    design = TABLE_DESIGN[table]
+    ddl = 'DISTSTYLE {}'.format(design['diststyle'])
+    if design.get('distkey'):
+        ddl += ' DISTKEY ({})'.format(design['distkey'])
+    if design.get('sortkey'):
+        ddl += ' COMPOUND SORTKEY ({})'.format(', '.join(design['sortkey']))
+    return ddl
+
 
 # CREATE TABLES
 
@@ -42,8 +84,8 @@ staging_events_table_create= ("""
         ts BIGINT,
         userAgent TEXT,
         userId INT
-    )
-""")
+    ) {}
+""").format(table_design_ddl('staging_events'))
 
 staging_songs_table_create = ("""
     CREATE TABLE IF NOT EXISTS staging_songs (
@@ -57,8 +99,8 @@ staging_songs_table_create = ("""
         song_id VARCHAR,
         title VARCHAR,
         year INT
-    )
-""")
+    ) {}
+""").format(table_design_ddl('staging_songs'))
 
 songplay_table_create = ("""
     CREATE TABLE IF NOT EXISTS songplays (
@@ -71,8 +113,8 @@ songplay_table_create = ("""
         session_id INT,
         location TEXT,
         user_agent TEXT
-    )
-""")
+    ) {}
+""").format(table_design_ddl('songplays'))
 
 user_table_create = ("""
     CREATE TABLE IF NOT EXISTS users (
@@ -81,8 +123,8 @@ user_table_create = ("""
         last_name VARCHAR,
         gender CHAR(1),
         level VARCHAR
-    )
-""")
+    ) {}
+""").format(table_design_ddl('users'))
 
 song_table_create = ("""
     CREATE TABLE IF NOT EXISTS songs (
@@ -91,8 +133,8 @@ song_table_create = ("""
         artist_id VARCHAR,
         year INT,
         duration FLOAT
-    )
-""")
+    ) {}
+""").format(table_design_ddl('songs'))
 
 artist_table_create = ("""
     CREATE TABLE IF NOT EXISTS artists (
@@ -101,8 +143,8 @@ artist_table_create = ("""
         location TEXT ,
         latitude FLOAT ,
         longitude FLOAT
-    )
-""")
+    ) {}
+""").format(table_design_ddl('artists'))
 
 time_table_create = ("""
     CREATE TABLE IF NOT EXISTS time (
@@ -113,8 +155,17 @@ time_table_create = ("""
         month INT,
         year INT,
         weekday VARCHAR
-    )
-""")
+    ) {}
+""").format(table_design_ddl('time'))
+
+# watermarks of the incremental load by name: ts of the latest event merged, last modified time of the
+# latest log object staged and version of the song_data listing
+load_state_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_state (
+        name VARCHAR,
+        value BIGINT
+    ) {}
+""").format(table_design_ddl('load_state'))
 
 # STAGING TABLES
 
@@ -134,6 +185,60 @@ staging_songs_copy = ("""
     region 'us-east-1';
 """).format(SONG_DATA, ARN)
 
+staging_events_manifest_copy = ("""
+    copy staging_events
+    from {0}
+    iam_role {1}
+    json {2}
+    gzip
+    manifest
+    region 'us-east-1';
+""").format(LOG_MANIFEST, ARN, LOG_JSONPATH)
+
+staging_songs_manifest_copy = ("""
+    copy staging_songs
+    from {0}
+    iam_role {1}
+    json 'auto'
+    gzip
+    manifest
+    region 'us-east-1';
+""").format(SONG_MANIFEST, ARN)
+
+# new log objects of an incremental load, the manifest URL is filled in by etl.py
+staging_events_new_copy = ("""
+    copy staging_events
+    from '{{}}'
+    iam_role {0}
+    json {1}
+    manifest
+    region 'us-east-1';
+""").format(ARN, LOG_JSONPATH)
+
+# TABLE DESIGN CHECKS
+
+# distribution and sort keys of the loaded tables, empty tables are not listed
+table_info_select = ("""
+    SELECT "table", diststyle, sortkey1, sortkey_num
+    FROM svv_table_info
+    WHERE schema = 'public'
+""")
+
+# distribution style and key columns of all tables
+table_def_select = ("""
+    SELECT d.tablename, c.reldiststyle, d."column", d.distkey, d.sortkey
+    FROM pg_table_def AS d
+    JOIN pg_namespace AS n ON n.nspname = d.schemaname
+    JOIN pg_class AS c ON c.relnamespace = n.oid AND c.relname = d.tablename
+    WHERE d.schemaname = 'public'
+""")
+
+# number of slices, packed files are written in multiples of it
+slice_count_select = "SELECT COUNT(*) FROM stv_slices"
+
+# rows loaded by the last COPY of the session
+copy_count_select = "SELECT pg_last_copy_count()"
+
 # FINAL TABLES
 
 songplay_table_insert = ("""
@@ -168,6 +273,7 @@ artist_table_insert = ("""
     WHERE artist_id IS NOT NULL
 """)
 
+# one row per distinct NextSong timestamp of the staged events, independent of the songplays insert
 time_table_insert = ("""
     INSERT INTO time (start_time, hour, day, week, month, year, weekday)
     SELECT start_time, 
@@ -177,12 +283,136 @@ time_table_insert = ("""
            extract(month from start_time), 
            extract(year from start_time), 
            extract(weekday from start_time)
-    FROM songplays
+    FROM (
+        SELECT DISTINCT timestamp with time zone 'epoch' + ts/1000 * interval '1 second' AS start_time
+        FROM staging_events
+        WHERE page = 'NextSong' AND ts IS NOT NULL
+    ) AS se
+    WHERE NOT EXISTS (SELECT 1 FROM time AS t WHERE t.start_time = se.start_time)
+""")
+
+# INCREMENTAL MERGE
+
+# staging_events is truncated before each incremental COPY, staging_songs only when song_data changed,
+# TRUNCATE commits right away
+staging_events_truncate = "TRUNCATE staging_events"
+staging_songs_truncate = "TRUNCATE staging_songs"
+
+load_state_select = "SELECT name, value FROM load_state"
+load_state_delete = "DELETE FROM load_state WHERE name = %s"
+load_state_insert = "INSERT INTO load_state (name, value) VALUES (%s, %s)"
+
+load_state_init = ("""
+    INSERT INTO load_state (name, value)
+    SELECT 'staging_events_ts', 0
+    WHERE NOT EXISTS (SELECT 1 FROM load_state WHERE name = 'staging_events_ts')
+""")
+
+# events up to the watermark are already merged
+staging_events_merged_delete = ("""
+    DELETE FROM staging_events
+    WHERE ts <= (SELECT value FROM load_state WHERE name = 'staging_events_ts')
+""")
+
+# users seen in the new events are replaced by their latest event
+user_table_merge_delete = ("""
+    DELETE FROM users
+    WHERE user_id IN (SELECT userId FROM staging_events WHERE page = 'NextSong')
+""")
+
+user_table_merge_insert = ("""
+    INSERT INTO users (user_id, first_name, last_name, gender, level)
+    SELECT userId, firstName, lastName, gender, level
+    FROM (
+        SELECT userId, firstName, lastName, gender, level,
+               ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS event_rank
+        FROM staging_events
+        WHERE page = 'NextSong' AND userId IS NOT NULL
+    ) AS se
+    WHERE event_rank = 1
+""")
+
+song_table_merge = ("""
+    INSERT INTO songs (song_id, title, artist_id, year, duration)
+    SELECT DISTINCT song_id, title, artist_id, year, duration
+    FROM staging_songs AS ss
+    WHERE song_id IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM songs AS s WHERE s.song_id = ss.song_id)
 """)
 
+artist_table_merge = ("""
+    INSERT INTO artists (artist_id, name, location, latitude, longitude)
+    SELECT DISTINCT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+    FROM staging_songs AS ss
+    WHERE artist_id IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM artists AS a WHERE a.artist_id = ss.artist_id)
+""")
+
+load_state_update = ("""
+    UPDATE load_state
+    SET value = (SELECT MAX(ts) FROM staging_events)
+    WHERE name = 'staging_events_ts'
+    AND EXISTS (SELECT 1 FROM staging_events)
+""")
+
+# MAINTENANCE
+
+# fact and dimension tables maintained after each load, the staging tables are reloaded every run
+maintained_tables = ['songplays', 'users', 'songs', 'artists', 'time']
+
+# percent of rows changed since the last ANALYZE (stats_off) and percent of unsorted rows of the loaded tables
+table_maintenance_select = ("""
+    SELECT "table", stats_off, unsorted
+    FROM svv_table_info
+    WHERE schema = 'public'
+""")
+
+table_analyze = "ANALYZE {}"
+table_vacuum_sort = "VACUUM SORT ONLY {}"
+
+# analytical queries whose plans are captured after each load, by name
+critical_queries = {
+    'top_songs': ("""
+        SELECT s.title, a.name, COUNT(*) AS plays
+        FROM songplays AS sp
+        JOIN songs AS s ON s.song_id = sp.song_id
+        JOIN artists AS a ON a.artist_id = sp.artist_id
+        GROUP BY s.title, a.name
+        ORDER BY plays DESC
+        LIMIT 10
+    """),
+    'plays_by_hour': ("""
+        SELECT t.hour, COUNT(*) AS plays
+        FROM songplays AS sp
+        JOIN time AS t ON t.start_time = sp.start_time
+        GROUP BY t.hour
+        ORDER BY t.hour
+    """),
+    'plays_by_level_and_weekday': ("""
+        SELECT u.level, t.weekday, COUNT(*) AS plays
+        FROM songplays AS sp
+        JOIN users AS u ON u.user_id = sp.user_id
+        JOIN time AS t ON t.start_time = sp.start_time
+        GROUP BY u.level, t.weekday
+    """),
+}
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, load_state_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, load_state_table_drop]
+copy_table_queries = [staging_events_manifest_copy, staging_songs_manifest_copy] if PACKED_DATA else [staging_events_copy, staging_songs_copy]
 insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+merge_table_queries = [load_state_table_create, load_state_init, staging_events_merged_delete, songplay_table_insert, user_table_merge_delete, user_table_merge_insert, song_table_merge, artist_table_merge, time_table_insert, load_state_update]
+# the watermark of a full load is the latest event it staged
+load_state_seed_queries = [load_state_table_create, load_state_init, load_state_update]
+
+# statements by name with the names of the statements whose tables they read, for dag.run_dag
+copy_table_dag = dict(zip(['staging_events', 'staging_songs'], [(query, []) for query in copy_table_queries]))
+insert_table_dag = {
+    'songplays': (songplay_table_insert, []),
+    'users': (user_table_insert, []),
+    'songs': (song_table_insert, []),
+    'artists': (artist_table_insert, []),
+    'time': (time_table_insert, []),
+}
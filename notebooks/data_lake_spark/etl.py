@@ -1,10 +1,13 @@
 import configparser
 from datetime import datetime
 import os
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, monotonically_increasing_id
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear
-from pyspark.sql import types as t
+from pyspark.sql.functions import col, monotonically_increasing_id
+from transforms import with_event_time, get_time_table, get_song_lookup, join_songs
+from schemas import SONG_DATA_SCHEMA, LOG_DATA_SCHEMA, read_json
+from writer import write_parquet
+from src.instrumentation.metrics import metrics
 
 config = configparser.ConfigParser()
 config.read('dl.cfg')
@@ -12,6 +15,22 @@ config.read('dl.cfg')
 os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY'] = config['AWS']['AWS_SECRET_ACCESS_KEY']
 
+# StorageLevel the parsed song_data is kept at while the songs, artists and songplays tables are built
+SONG_DATA_STORAGE_LEVEL = config.get('SPARK', 'SONG_DATA_STORAGE_LEVEL', fallback='MEMORY_AND_DISK')
+
+# the songplays join broadcasts song lookups up to this size, Spark's default autoBroadcastJoinThreshold
+SONG_LOOKUP_BROADCAST_BYTES = config.getint('SPARK', 'SONG_LOOKUP_BROADCAST_BYTES', fallback=10 * 1024 * 1024)
+
+# buckets the events of a heavy-hitter song are spread over when the songplays join is not broadcast
+SALT_BUCKETS = config.getint('SPARK', 'SALT_BUCKETS', fallback=8)
+
+# estimated uncompressed bytes of each parquet file written per output partition
+PARQUET_FILE_BYTES = config.getint('SPARK', 'PARQUET_FILE_BYTES', fallback=128 * 1024 * 1024)
+
+# song_data columns used by the songs and artists tables and the songplays join
+SONG_DATA_COLUMNS = ["song_id", "title", "artist_id", "year", "duration",
+                     "artist_name", "artist_location", "artist_latitude", "artist_longitude"]
+
 
 def create_spark_session():
     """Create an Apache Spark session.
@@ -25,7 +44,50 @@ def create_spark_session():
     return spark
 
 
-def process_song_data(spark, input_data, output_data, run_start_time):
+def get_input_bytes(spark, input_data):
+    """Sum the sizes of the files matched by an input path or glob.
+
+    :param spark: Spark session.
+    :param input_data: Path or glob of the input files.
+    :return: Total size of the files in bytes.
+    """
+    jvm = spark.sparkContext._jvm
+    path = jvm.org.apache.hadoop.fs.Path(input_data)
+    statuses = path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()).globStatus(path)
+    return sum(status.getLen() for status in statuses or [])
+
+
+@metrics.instrument()
+def load_song_data(spark, input_data, output_data, run_start_time, storage_level=None):
+    """Load JSON input data (song_data) once, projected to SONG_DATA_COLUMNS and persisted, to be shared by
+    process_song_data and process_log_data.
+
+    :param spark: Spark session.
+    :param input_data: Path to song data.
+    :param output_data: Path to output, records not matching the schema are quarantined there.
+    :param run_start_time: Start time of processing.
+    :param storage_level: Name of the StorageLevel to persist at, SONG_DATA_STORAGE_LEVEL when None.
+    :return: df_sd - Persisted song data DataFrame, unpersist it once the tables built from it are no longer used.
+    """
+    start_sdl = datetime.now()
+    print("Reading song_data files from {}...".format(input_data))
+    quarantine_path = output_data + "song_data_quarantine.json" + "_" + run_start_time
+    storage_level = getattr(StorageLevel, storage_level or SONG_DATA_STORAGE_LEVEL)
+    df_sd, num_songs, quarantined_sd = read_json(spark, input_data, SONG_DATA_SCHEMA, quarantine_path,
+                                                 SONG_DATA_COLUMNS, storage_level)
+    stop_sdl = datetime.now()
+    total_sdl = stop_sdl - start_sdl
+    print("...finished reading song_data in {}.".format(total_sdl))
+    print("Song_data schema:")
+    df_sd.printSchema()
+
+    metrics.add(rows_read=num_songs + quarantined_sd, rows_rejected=quarantined_sd,
+                bytes_processed=get_input_bytes(spark, input_data))
+    return df_sd
+
+
+@metrics.instrument()
+def process_song_data(spark, input_data, output_data, run_start_time, df_sd=None):
     """Load JSON input data, process the data to extract song_table and
     artists_table and store data to parquet files.
 
@@ -33,26 +95,16 @@ def process_song_data(spark, input_data, output_data, run_start_time):
     :param input_data: Path to data.
     :param output_data: Path to parquet output.
     :param run_start_time: Start time of processing.
+    :param df_sd: Song data returned by load_song_data, loaded from input_data when None.
     :return: songs_table - Directory with parquet files stored in output_data path.
     artists_table - Directory with parquet files stored in output_data path.
     """
 
     # ===== Load song_data =====
     start_sd = datetime.now()
-    start_sdl = datetime.now()
     print("Start processing song_data JSON files...")
-
-    # Get filepath to song data file
-    song_data = input_data
-
-    # Read song data file
-    print("Reading song_data files from {}...".format(song_data))
-    df_sd = spark.read.json(song_data)
-    stop_sdl = datetime.now()
-    total_sdl = stop_sdl - start_sdl
-    print("...finished reading song_data in {}.".format(total_sdl))
-    print("Song_data schema:")
-    df_sd.printSchema()
+    if df_sd is None:
+        df_sd = load_song_data(spark, input_data, output_data, run_start_time)
 
     # ===== Create and write songs_table =====
     # Extract columns to create songs table
@@ -62,7 +114,6 @@ def process_song_data(spark, input_data, output_data, run_start_time):
     songs_table = spark.sql("""
         SELECT song_id, title, artist_id, year, duration
         FROM songs_table_DF
-        ORDER BY song_id
     """)
     print("Songs_table schema:")
     songs_table.printSchema()
@@ -74,10 +125,12 @@ def process_song_data(spark, input_data, output_data, run_start_time):
 
     # Write DF to Spark parquet file (partitioned by year and artist_id)
     print("Writing songs_table parquet files to {}...".format(songs_table_path))
-    songs_table.write.mode("overwrite").partitionBy("year", "artist_id").parquet(songs_table_path)
+    num_files, num_rows = write_parquet(songs_table, songs_table_path, ["year", "artist_id"], ["song_id"],
+                                        PARQUET_FILE_BYTES)
+    metrics.add(rows_written=num_rows)
     stop_st = datetime.now()
     total_st = stop_st - start_st
-    print("...finished writing songs_table in {}.".format(total_st))
+    print("...finished writing songs_table in up to {} files in {}.".format(num_files, total_st))
 
     # ===== Create and write artists_table =====
     # Extract columns to create artists table
@@ -90,7 +143,6 @@ def process_song_data(spark, input_data, output_data, run_start_time):
                 artist_latitude  AS latitude,
                 artist_longitude AS longitude
         FROM artists_table_DF
-        ORDER BY artist_id desc
     """)
     artists_table.printSchema()
     artists_table.show(5, truncate=False)
@@ -98,10 +150,12 @@ def process_song_data(spark, input_data, output_data, run_start_time):
     # Write artists table to parquet files
     artists_table_path = output_data + "artists_table.parquet" + "_" + run_start_time
     print("Writing artists_table parquet files to {}...".format(artists_table_path))
-    songs_table.write.mode("overwrite").parquet(artists_table_path)
+    num_files, num_rows = write_parquet(artists_table, artists_table_path, sort_cols=["artist_id"],
+                                        target_file_bytes=PARQUET_FILE_BYTES)
+    metrics.add(rows_written=num_rows)
     stop_at = datetime.now()
     total_at = stop_at - start_at
-    print("...finished writing artists_table in {}.".format(total_at))
+    print("...finished writing artists_table in up to {} files in {}.".format(num_files, total_at))
     stop_sd = datetime.now()
     total_sd = stop_sd - start_sd
     print("Finished processing song_data in {}.\n".format(total_sd))
@@ -109,7 +163,8 @@ def process_song_data(spark, input_data, output_data, run_start_time):
     return songs_table, artists_table
 
 
-def process_log_data(spark, input_data_ld, input_data_sd, output_data, run_start_time):
+@metrics.instrument()
+def process_log_data(spark, input_data_ld, input_data_sd, output_data, run_start_time, df_sd=None):
     """ Load JSON input data (log_data) from input_data path, process the data to extract users_table, time_table,
     songplays_table, and store the queried data to parquet files.
 
@@ -118,9 +173,11 @@ def process_log_data(spark, input_data_ld, input_data_sd, output_data, run_start
     :param input_data_sd: Path to input song data.
     :param output_data: Path to output parquet files.
     :param run_start_time: Start of processing time.
+    :param df_sd: Song data returned by load_song_data, loaded from input_data_sd when None.
     :return: users_table - Directory with users_table parquet files stored in output_data path.
     time_table - Directory with time_table parquet files stored in output_data path.
     songplayes_table - Directory with songplays_table parquet files stored in output_data path.
+    df_ld - Persisted log data the returned tables are derived from, unpersist it once they are no longer used.
     """
     # ===== Load log_data =====
     start_ld = datetime.now()
@@ -131,7 +188,8 @@ def process_log_data(spark, input_data_ld, input_data_sd, output_data, run_start
 
     # Read log data file
     print("Reading log_data files from {}...".format(log_data))
-    df_ld = spark.read.json(log_data)
+    quarantine_path = output_data + "log_data_quarantine.json" + "_" + run_start_time
+    df_ld, num_events, quarantined_ld = read_json(spark, log_data, LOG_DATA_SCHEMA, quarantine_path)
     stop_ldl = datetime.now()
     total_ldl = stop_ldl - start_ldl
     print("...finished reading log_data in {}.".format(total_ldl))
@@ -150,7 +208,6 @@ def process_log_data(spark, input_data_ld, input_data_sd, output_data, run_start
                          gender,
                          level
         FROM users_table_DF
-        ORDER BY last_name
     """)
     print("Users_table schema:")
     users_table.printSchema()
@@ -160,50 +217,25 @@ def process_log_data(spark, input_data_ld, input_data_sd, output_data, run_start
     # Write users table to parquet files
     users_table_path = output_data + "users_table.parquet" + "_" + run_start_time
     print("Writing users_table parquet files to {}...".format(users_table_path))
-    users_table.write.mode("overwrite").parquet(users_table_path)
+    num_files, num_rows = write_parquet(users_table, users_table_path, sort_cols=["last_name"],
+                                        target_file_bytes=PARQUET_FILE_BYTES)
+    metrics.add(rows_written=num_rows)
     stop_ut = datetime.now()
     total_ut = stop_ut - start_ut
-    print("...finished writing users_table in {}.".format(total_ut))
+    print("...finished writing users_table in up to {} files in {}.".format(num_files, total_ut))
 
     # ===== Create and write time_table =====
     # Create timestamp column from original timestamp column
     start_tt = datetime.now()
-    print("Creating timestamp column...")
-
-    @udf(t.TimestampType())
-    def get_timestamp(ts):
-        return datetime.fromtimestamp(ts / 1000.0)
-
-    df_ld_filtered = df_ld_filtered.withColumn("timestamp", get_timestamp("ts"))
-    df_ld_filtered.printSchema()
-    df_ld_filtered.show(5)
-
-    # create datetime column from original timestamp column
-    print("Creating datetime column...")
-
-    @udf(t.StringType())
-    def get_datetime(ts):
-        return datetime.fromtimestamp(ts / 1000.0).strftime('%Y-%m-%d %H:%M:%S')
-
-    df_ld_filtered = df_ld_filtered.withColumn("datetime", get_datetime("ts"))
+    print("Creating timestamp and datetime columns...")
+    df_ld_filtered = with_event_time(df_ld_filtered)
     print("Log_data + timestamp + datetime columns schema:")
     df_ld_filtered.printSchema()
     print("Log_data + timestamp + datetime columns examples:")
     df_ld_filtered.show(5)
 
     # Extract columns to create time table.
-    df_ld_filtered.createOrReplaceTempView("time_table_DF")
-    time_table = spark.sql("""
-        SELECT  DISTINCT datetime AS start_time,
-                         hour(timestamp) AS hour,
-                         day(timestamp)  AS day,
-                         weekofyear(timestamp) AS week,
-                         month(timestamp) AS month,
-                         year(timestamp) AS year,
-                         dayofweek(timestamp) AS weekday
-        FROM time_table_DF
-        ORDER BY start_time
-    """)
+    time_table = get_time_table(df_ld_filtered)
     print("Time_table schema:")
     time_table.printSchema()
     print("Time_table examples:")
@@ -212,23 +244,28 @@ def process_log_data(spark, input_data_ld, input_data_sd, output_data, run_start
     # Write time table to parquet files partitioned by year and month.
     time_table_path = output_data + "time_table.parquet" + "_" + run_start_time
     print("Writing time_table parquet files to {}...".format(time_table_path))
-    time_table.write.mode("overwrite").partitionBy("year", "month").parquet(time_table_path)
+    num_files, num_rows = write_parquet(time_table, time_table_path, ["year", "month"], ["start_time"],
+                                        PARQUET_FILE_BYTES)
+    metrics.add(rows_written=num_rows)
     stop_tt = datetime.now()
     total_tt = stop_tt - start_tt
-    print("...finished writing time_table in {}.".format(total_tt))
+    print("...finished writing time_table in up to {} files in {}.".format(num_files, total_tt))
 
     # ===== Create and write songplays_table =====
-    # Read in song data to use for songplays table.
+    # Use song data of load_song_data for songplays table.
     start_spt = datetime.now()
-    song_data = input_data_sd
-    print("Reading song_data files from {}...".format(song_data))
-    df_sd = spark.read.json(song_data)
+    if df_sd is None:
+        df_sd = load_song_data(spark, input_data_sd, output_data, run_start_time)
 
-    # Join log_data and song_data DFs
+    # Join log_data and song_data DFs on title, artist name and duration
     print("Joining log_data and song_data DFs...")
-    df_ld_sd_joined = df_ld_filtered.join(df_sd, (df_ld_filtered.artist == df_sd.artist_name) &
-                                          (df_ld_filtered.song == df_sd.title))
-    print("...finished joining song_data and log_data DFs.")
+    with metrics.stage('join_songs'):
+        song_lookup = get_song_lookup(df_sd)
+        df_ld_sd_joined, join_strategy, heavy = join_songs(df_ld_filtered, song_lookup,
+                                                           SONG_LOOKUP_BROADCAST_BYTES, SALT_BUCKETS)
+        # counts the runs that used the chosen strategy, e.g. broadcast_joins
+        metrics.add(**{join_strategy + '_joins': 1})
+    print("...finished joining song_data and log_data DFs with a {} join.".format(join_strategy))
     print("Joined song_data + log_data schema:")
     df_ld_sd_joined.printSchema()
     print("Joined song_data + log_data examples:")
@@ -247,9 +284,10 @@ def process_log_data(spark, input_data_ld, input_data_sd, output_data, run_start
                 artist_id   AS artist_id,
                 sessionId   AS session_id,
                 location    AS location,
-                userAgent   AS user_agent
+                userAgent   AS user_agent,
+                year(timestamp)  AS year,
+                month(timestamp) AS month
         FROM songplays_table_DF
-        ORDER BY (user_id, session_id)
     """)
 
     print("Songplays_table schema:")
@@ -260,12 +298,23 @@ def process_log_data(spark, input_data_ld, input_data_sd, output_data, run_start
     # Write songplays table to parquet files partitioned by year and month
     songplays_table_path = output_data + "songplays_table.parquet" + "_" + run_start_time
     print("Writing songplays_table parquet files to {}...".format(songplays_table_path))
-    time_table.write.mode("overwrite").partitionBy("year", "month").parquet(songplays_table_path)
+    num_files, num_rows = write_parquet(songplays_table, songplays_table_path, ["year", "month"],
+                                        ["user_id", "session_id"], PARQUET_FILE_BYTES)
+    metrics.add(rows_written=num_rows)
+    # the heavy-hitter keys of a salted join are only read by the songplays write
+    if heavy is not None:
+        heavy.unpersist()
     stop_spt = datetime.now()
     total_spt = stop_spt - start_spt
-    print("...finished writing songplays_table in {}.".format(total_spt))
+    print("...finished writing songplays_table in up to {} files in {}.".format(num_files, total_spt))
+
+    # the rows written are counted by write_parquet, the NextSong events are counted on the persisted df_ld
+    num_songplay_events = df_ld.filter(df_ld.page == 'NextSong').count()
+    metrics.add(rows_read=num_events + quarantined_ld,
+                rows_rejected=num_events - num_songplay_events + quarantined_ld,
+                bytes_processed=get_input_bytes(spark, log_data))
 
-    return users_table, time_table, songplays_table
+    return users_table, time_table, songplays_table, df_ld
 
 
 def query_table_count(spark, table):
@@ -354,9 +403,11 @@ def main():
     output_data = config['LOCAL']['OUTPUT_DATA_LOCAL']
 
     # Use AWS input_data + output_data paths.
-    songs_table, artists_table = process_song_data(spark, input_data_sd, output_data, run_start_time)
-    users_table, time_table, songplays_table = process_log_data(spark, input_data_ld, input_data_sd, output_data,
-                                                                run_start_time)
+    # song_data is read once for the songs, artists and songplays tables.
+    df_sd = load_song_data(spark, input_data_sd, output_data, run_start_time)
+    songs_table, artists_table = process_song_data(spark, input_data_sd, output_data, run_start_time, df_sd)
+    users_table, time_table, songplays_table, df_ld = process_log_data(spark, input_data_ld, input_data_sd,
+                                                                       output_data, run_start_time, df_sd)
     print("Finished the ETL pipeline processing.")
     print("ALL DONE.")
 
@@ -364,9 +415,12 @@ def main():
     print("FINISHED ETL pipeline (to process song_data and log_data) at {}" \
           .format(stop))
     print("TIME: {}".format(stop - start))
+    print("Metrics written to {} and {}.".format(*metrics.write('data_lake_spark_etl')))
 
     print("Running example queries...")
     query_examples(spark, songs_table, artists_table, users_table, time_table, songplays_table)
+    df_ld.unpersist()
+    df_sd.unpersist()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+from pyspark import StorageLevel
+from pyspark.sql.functions import col, input_file_name
+from pyspark.sql.types import StructType, StructField, StringType, LongType, DoubleType
+
+# column holding the raw text of records that do not match the declared schema
+CORRUPT_RECORD = "_corrupt_record"
+
+# song_data JSON files, one song per file
+SONG_DATA_SCHEMA = StructType([
+    StructField("artist_id", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_longitude", DoubleType()),
+    StructField("artist_name", StringType()),
+    StructField("duration", DoubleType()),
+    StructField("num_songs", LongType()),
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("year", LongType()),
+])
+
+# log_data JSON files, one event per line; userId is empty for logged out users, so it is read as a string
+LOG_DATA_SCHEMA = StructType([
+    StructField("artist", StringType()),
+    StructField("auth", StringType()),
+    StructField("firstName", StringType()),
+    StructField("gender", StringType()),
+    StructField("itemInSession", LongType()),
+    StructField("lastName", StringType()),
+    StructField("length", DoubleType()),
+    StructField("level", StringType()),
+    StructField("location", StringType()),
+    StructField("method", StringType()),
+    StructField("page", StringType()),
+    StructField("registration", DoubleType()),
+    StructField("sessionId", LongType()),
+    StructField("song", StringType()),
+    StructField("status", LongType()),
+    StructField("ts", LongType()),
+    StructField("userAgent", StringType()),
+    StructField("userId", StringType()),
+])
+
+
+def read_json(spark, input_data, schema, quarantine_path=None, columns=None,
+              storage_level=StorageLevel.MEMORY_AND_DISK):
+    """Read JSON files with a declared schema, without the schema inference pass over all input files.
+    Records that are not valid JSON or whose values do not fit the schema are written to quarantine_path
+    instead of failing the job.
+
+    The input is read once: Spark only allows querying the corrupt record column of a cached DataFrame, so
+    the parsed records are cached while the quarantined ones are counted, then the matching records are
+    projected to columns and persisted at storage_level for the later actions of the job.
+
+    :param spark: Spark session.
+    :param input_data: Path or glob of the JSON files.
+    :param schema: StructType of the records, e.g. SONG_DATA_SCHEMA or LOG_DATA_SCHEMA.
+    :param quarantine_path: Path to write the quarantined records to as JSON lines of source_file and record,
+    None to drop them.
+    :param columns: Columns to keep, all the columns of schema when None.
+    :param storage_level: StorageLevel of the returned DataFrame.
+    :return: df - Persisted DataFrame of the matching records. Unpersist it only once the DataFrames derived
+    from it are no longer used: recomputed from the files, queries needing no data column would only read the
+    corrupt record column, which Spark refuses.
+    num_rows - Number of matching records, counted while persisting df.
+    quarantined - Number of quarantined records.
+    """
+    parsed = spark.read \
+        .schema(StructType(schema.fields + [StructField(CORRUPT_RECORD, StringType())])) \
+        .option("mode", "PERMISSIVE") \
+        .option("columnNameOfCorruptRecord", CORRUPT_RECORD) \
+        .json(input_data) \
+        .withColumn("source_file", input_file_name()) \
+        .persist(StorageLevel.MEMORY_AND_DISK)
+
+    rejected = parsed.filter(col(CORRUPT_RECORD).isNotNull()) \
+        .select("source_file", col(CORRUPT_RECORD).alias("record"))
+    quarantined = rejected.count()
+    if quarantined and quarantine_path:
+        print("Writing {} records not matching the schema to {}...".format(quarantined, quarantine_path))
+        rejected.write.mode("overwrite").json(quarantine_path)
+
+    df = parsed.filter(col(CORRUPT_RECORD).isNull()) \
+        .select(columns or schema.fieldNames()) \
+        .persist(storage_level)
+    num_rows = df.count()
+    parsed.unpersist()
+    return df, num_rows, quarantined
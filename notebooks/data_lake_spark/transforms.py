@@ -0,0 +1,103 @@
+from pyspark.sql.functions import col, expr, date_format, hour, dayofmonth, weekofyear, month, year, dayofweek
+from pyspark.sql.functions import lit, coalesce, length, sum as sum_, broadcast, when, rand, explode, array
+
+
+def with_event_time(df):
+    """Add the event time of the ts epoch milliseconds as built-in Spark expressions, which run in the
+    JVM on whole column batches instead of sending every row to a Python worker like a UDF.
+
+    :param df: Log data DataFrame with a ts column.
+    :return: df with a timestamp column (TimestampType, in the session time zone) and a datetime column
+    ('yyyy-MM-dd HH:mm:ss' string of timestamp).
+    """
+    return df.withColumn("timestamp", expr("timestamp_millis(ts)")) \
+        .withColumn("datetime", date_format(col("timestamp"), "yyyy-MM-dd HH:mm:ss"))
+
+
+def get_time_table(df):
+    """Extract the time table from log data with the with_event_time columns.
+
+    :param df: Log data DataFrame with timestamp and datetime columns.
+    :return: time_table - One row per distinct start_time with its calendar fields, unordered: write_parquet
+    sorts the files by start_time.
+    """
+    return df.select(col("datetime").alias("start_time"),
+                     hour("timestamp").alias("hour"),
+                     dayofmonth("timestamp").alias("day"),
+                     weekofyear("timestamp").alias("week"),
+                     month("timestamp").alias("month"),
+                     year("timestamp").alias("year"),
+                     dayofweek("timestamp").alias("weekday")) \
+        .distinct()
+
+
+def get_song_lookup(df_sd):
+    """Project song data to the lookup of the songplays join, one song per (title, artist_name, duration) like
+    the song_select of the Postgres pipeline.
+
+    :param df_sd: Song data DataFrame.
+    :return: song_lookup - DataFrame of title, artist_name, duration, song_id and artist_id.
+    """
+    return df_sd.select("title", "artist_name", "duration", "song_id", "artist_id") \
+        .dropDuplicates(["title", "artist_name", "duration"])
+
+
+def get_size_in_bytes(song_lookup):
+    """Estimate the size of the song lookup from the length of its values.
+
+    :param song_lookup: DataFrame returned by get_song_lookup.
+    :return: Estimated size in bytes.
+    """
+    row_bytes = lit(8)
+    for column in ("title", "artist_name", "song_id", "artist_id"):
+        row_bytes = row_bytes + coalesce(length(column), lit(0))
+    return song_lookup.select(sum_(row_bytes)).first()[0] or 0
+
+
+def join_songs(events, song_lookup, broadcast_bytes, salt_buckets):
+    """Join NextSong events to the song lookup on song title, artist name and duration.
+
+    The lookup is broadcast when it is at most broadcast_bytes, so the events are not shuffled. Otherwise both
+    sides are shuffled on the join key, and the keys played so often that their events would fill more than
+    one shuffle partition are salted: their events are spread over salt_buckets random buckets and their
+    lookup rows are copied to every bucket.
+
+    :param events: NextSong events with song, artist and length columns.
+    :param song_lookup: DataFrame returned by get_song_lookup.
+    :param broadcast_bytes: Largest lookup size in bytes to broadcast.
+    :param salt_buckets: Buckets the events of each heavy-hitter key are spread over.
+    :return: joined - Events with the song_id and artist_id of their song.
+    strategy - 'broadcast', 'salted' or 'shuffle'.
+    heavy - Persisted heavy-hitter keys joined reads in the salted join, None otherwise. Unpersist it once
+    joined is written.
+    """
+    if get_size_in_bytes(song_lookup) <= broadcast_bytes:
+        return events.join(broadcast(song_lookup), (events.song == song_lookup.title) &
+                           (events.artist == song_lookup.artist_name) &
+                           (events.length == song_lookup.duration)), "broadcast", None
+
+    partitions = int(events.sparkSession.conf.get("spark.sql.shuffle.partitions"))
+    heavy = events.groupBy("song", "artist").count() \
+        .filter(col("count") > events.count() / partitions) \
+        .select("song", "artist", lit(True).alias("heavy")) \
+        .cache()
+    if heavy.count() == 0:
+        heavy.unpersist()
+        return events.join(song_lookup, (events.song == song_lookup.title) &
+                           (events.artist == song_lookup.artist_name) &
+                           (events.length == song_lookup.duration)), "shuffle", None
+
+    salted_events = events.join(broadcast(heavy), ["song", "artist"], "left") \
+        .withColumn("salt", when(col("heavy"), (rand() * salt_buckets).cast("int")).otherwise(0)) \
+        .drop("heavy")
+    salted_lookup = song_lookup \
+        .join(broadcast(heavy.withColumnRenamed("song", "title").withColumnRenamed("artist", "artist_name")),
+              ["title", "artist_name"], "left") \
+        .withColumn("lookup_salt", explode(when(col("heavy"), array(*[lit(i) for i in range(salt_buckets)]))
+                                           .otherwise(array(lit(0))))) \
+        .drop("heavy")
+    joined = salted_events.join(salted_lookup, (salted_events.song == salted_lookup.title) &
+                                (salted_events.artist == salted_lookup.artist_name) &
+                                (salted_events.length == salted_lookup.duration) &
+                                (salted_events.salt == salted_lookup.lookup_salt))
+    return joined.drop("salt", "lookup_salt"), "salted", heavy
@@ -0,0 +1,82 @@
+import math
+from pyspark.sql.functions import col, lit, length, coalesce, ceil, greatest, sum as sum_, count, broadcast, pmod
+from pyspark.sql.functions import hash as hash_
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType
+
+
+def get_row_bytes(df):
+    """Estimate the uncompressed size of each row from the length of its strings and 8 bytes for each of its
+    other values, the size of the longs, doubles and timestamps of the tables.
+
+    :param df: DataFrame to estimate.
+    :return: Column expression of the estimated row size in bytes.
+    """
+    row_bytes = lit(0)
+    for field in df.schema.fields:
+        if isinstance(field.dataType, StringType):
+            row_bytes = row_bytes + coalesce(length(col(field.name)), lit(0))
+        else:
+            row_bytes = row_bytes + lit(8)
+    return row_bytes
+
+
+def write_parquet(df, path, partition_cols=(), sort_cols=(), target_file_bytes=128 * 1024 * 1024):
+    """Write df to parquet files of about target_file_bytes, sorted by sort_cols within each file instead of
+    a global ORDER BY, which range partitions the whole table.
+
+    The rows of each output partition (distinct partition_cols value) are hashed on all their columns to as
+    many files as its estimated size needs and repartitioned on the partition columns and that file number, so
+    each task writes whole files of its output partitions rather than every task writing a small file to every
+    output partition. Files of one output partition hashed to the same task are written as one, so some files
+    are a multiple of target_file_bytes. df is evaluated twice, once to estimate the output partition sizes,
+    counting its rows on the way, and once to write.
+
+    :param df: DataFrame to write.
+    :param path: Path of the parquet output.
+    :param partition_cols: Columns of the output partition directories, none to write a flat directory.
+    :param sort_cols: Columns each file is sorted by.
+    :param target_file_bytes: Estimated uncompressed bytes per file; parquet encoding and compression make the
+    files smaller.
+    :return: num_files - Number of files planned, an upper bound of the files written.
+    num_rows - Number of rows written.
+    """
+    partition_cols, sort_cols = list(partition_cols), list(sort_cols)
+    max_tasks = int(df.sparkSession.conf.get("spark.sql.shuffle.partitions"))
+
+    if not partition_cols:
+        total_bytes, num_rows = df.select(sum_(get_row_bytes(df)), count(lit(1))).first()
+        num_files = max(1, int(math.ceil((total_bytes or 0) / float(target_file_bytes))))
+        df.repartition(num_files) \
+            .sortWithinPartitions(*sort_cols) \
+            .write.mode("overwrite").parquet(path)
+        return num_files, num_rows
+
+    # files of each output partition; only the ones needing several files are joined back, null safe as
+    # partition values may be null
+    sizes = df.groupBy(*partition_cols) \
+        .agg(greatest(lit(1), ceil(sum_(get_row_bytes(df)) / target_file_bytes)).cast("int").alias("_files"),
+             count(lit(1)).alias("_rows")) \
+        .collect()
+    num_files = sum(row["_files"] for row in sizes)
+    num_rows = sum(row["_rows"] for row in sizes)
+    large = [tuple(row[c] for c in partition_cols) + (row["_files"],) for row in sizes if row["_files"] > 1]
+    if large:
+        schema = StructType([StructField("_size_" + c, df.schema[c].dataType) for c in partition_cols] +
+                            [StructField("_files", IntegerType())])
+        large = df.sparkSession.createDataFrame(large, schema)
+        condition = None
+        for c in partition_cols:
+            equal = df[c].eqNullSafe(large["_size_" + c])
+            condition = equal if condition is None else condition & equal
+        df = df.join(broadcast(large), condition, "left") \
+            .withColumn("_file", pmod(hash_(*[df[c] for c in df.columns]), coalesce(col("_files"), lit(1)))) \
+            .drop(*(["_size_" + c for c in partition_cols] + ["_files"]))
+    else:
+        df = df.withColumn("_file", lit(0))
+
+    # the task count only bounds the parallelism: a task writes one file per output partition it holds
+    df.repartition(max(1, min(num_files, max_tasks)), *(partition_cols + ["_file"])) \
+        .sortWithinPartitions(*(partition_cols + sort_cols)) \
+        .drop("_file") \
+        .write.mode("overwrite").partitionBy(*partition_cols).parquet(path)
+    return num_files, num_rows
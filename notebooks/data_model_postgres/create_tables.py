@@ -1,5 +1,6 @@
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, create_partitioned_table_queries, drop_table_queries, create_index_queries
 
 def create_database():
     """
@@ -35,11 +36,22 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, partitioned=False):
     """
     Creates each table using the queries in `create_table_queries` list. 
+    With `partitioned`, songplays is range partitioned by month of start_time
+    (`create_partitioned_table_queries`); the ETL creates the partitions.
     """
-    for query in create_table_queries:
+    for query in (create_partitioned_table_queries if partitioned else create_table_queries):
+        cur.execute(query)
+        conn.commit()
+
+
+def create_indexes(cur, conn):
+    """
+    Creates the secondary indexes using the queries in `create_index_queries` list.
+    """
+    for query in create_index_queries:
         cur.execute(query)
         conn.commit()
 
@@ -53,14 +65,20 @@ def main():
     
     Drops all the tables.
     
-    Creates all tables needed.
+    Creates all tables needed and their secondary indexes.
     
     Finally, closes the connection.
     """
+    parser = argparse.ArgumentParser(description='Create the sparkifydb tables.')
+    parser.add_argument('--partitioned', action='store_true',
+                        help='range partition songplays by month of start_time')
+    args = parser.parse_args()
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, partitioned=args.partitioned)
+    create_indexes(cur, conn)
 
     conn.close()
 
@@ -1,9 +1,46 @@
 import os
+import io
 import glob
+import argparse
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.util import Finalize
+from functools import partial
 import psycopg2
+from psycopg2 import errors, pool
+from psycopg2.extras import execute_values
 import pandas as pd
 from sql_queries import *
+from partitions import ensure_partitions
+from rollups import refresh_rollups
+from src.instrumentation.metrics import metrics
+from src.instrumentation.db import CountingCursor
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+# attempts per file when concurrent workers deadlock on the same dimension rows
+MAX_FILE_ATTEMPTS = 3
+
+# song files parsed per batch and threads reading them in the batch song loader
+SONG_BATCH_SIZE = 5000
+SONG_IO_THREADS = 8
+
+# NextSong events per batch of the streaming log reader
+LOG_BATCH_SIZE = 50000
+
+# per worker process state of the parallel loader, set by init_worker
+worker_pool = None
+worker_func = None
+
+@metrics.instrument()
 def process_song_file(cur, filepath):
     """
     Description: Processes a song file and insert song record and artist record into the database.
@@ -27,8 +64,201 @@ def process_song_file(cur, filepath):
     artist_data = list(df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]])
     cur.execute(artist_table_insert, artist_data)
 
+    metrics.add(rows_read=1, rows_written=2, bytes_processed=os.path.getsize(filepath))
+
+
+def read_json_file(filepath):
+    """
+    Description: Reads and parses a single JSON document.
+
+    Arguments:
+        filepath: JSON file path. 
+
+    Returns:
+        The parsed document.    
+    """
+    with open(filepath, 'rb') as f:
+        return json_loads(f.read())
+
+
+@metrics.instrument()
+def process_song_files_batch(cur, filepaths, seen_songs, seen_artists, executor):
+    """
+    Description: Processes a batch of song files with one insert per table.
+
+    The files are read and parsed by the executor's threads into one DataFrame, songs
+    and artists already seen in this run are dropped and the rest is written with
+    `execute_values`.
+
+    Arguments:
+        cur: the cursor object. 
+        filepaths: song data file paths. 
+        seen_songs: set of song_ids loaded so far, updated in place. 
+        seen_artists: set of artist_ids loaded so far, updated in place. 
+        executor: thread pool used for file reads. 
+
+    Returns:
+        None    
+    """
+    df = pd.DataFrame.from_records(list(executor.map(read_json_file, filepaths)))
+
+    # keep the first record of each song and artist, like the per-file inserts
+    song_df = df[["song_id", "title", "artist_id", "year", "duration"]].drop_duplicates(subset="song_id")
+    song_df = song_df[~song_df["song_id"].isin(seen_songs)]
+    seen_songs.update(song_df["song_id"])
+
+    artist_df = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]] \
+        .drop_duplicates(subset="artist_id")
+    artist_df = artist_df[~artist_df["artist_id"].isin(seen_artists)]
+    seen_artists.update(artist_df["artist_id"])
+
+    for query, data in ((song_table_batch_insert, song_df), (artist_table_batch_insert, artist_df)):
+        data = data.astype(object).where(data.notna(), None)
+        execute_values(cur, query, list(data.itertuples(index=False, name=None)), page_size=len(data) or 1)
+
+    metrics.add(rows_read=len(df), rows_written=len(song_df) + len(artist_df),
+                bytes_processed=sum(os.path.getsize(filepath) for filepath in filepaths))
+
+
+def process_song_data_batch(cur, conn, filepath, batch_size=SONG_BATCH_SIZE, io_threads=SONG_IO_THREADS,
+                            incremental=False):
+    """
+    Description: Processes all song files in batches, committing after each batch.
+
+    Arguments:
+        cur: the cursor object. 
+        conn:  the connection to the database.
+        filepath: song data directory. 
+        batch_size: number of files per batch. 
+        io_threads: number of threads reading files. 
+        incremental: only process files missing from or changed since the ingestion manifest. 
+
+    Returns:
+        None    
+    """
+
+    with metrics.stage(get_stage_name(filepath)):
+        all_files = get_files(filepath)
+        if incremental:
+            manifest_entries = dict((entry[0], entry) for entry in get_new_files(cur, all_files))
+            conn.commit()
+            all_files = list(manifest_entries)
+
+        # get total number of files found
+        num_files = len(all_files)
+        print('{} files found in {}'.format(num_files, filepath))
+
+        seen_songs, seen_artists = set(), set()
+        with ThreadPoolExecutor(io_threads) as executor:
+            for start in range(0, num_files, batch_size):
+                batch = all_files[start:start + batch_size]
+                process_song_files_batch(cur, batch, seen_songs, seen_artists, executor)
+                if incremental:
+                    record_files(cur, [manifest_entries[datafile] for datafile in batch])
+                conn.commit()
+                print('{}/{} files processed.'.format(start + len(batch), num_files))
+
+
+def get_time_df(df):
+    """
+    Description: Breaks the distinct event timestamps of a log DataFrame down into time dimension columns.
+
+    Arguments:
+        df: log events DataFrame with a `ts` column in epoch milliseconds. 
+
+    Returns:
+        DataFrame with the columns of the time table, one row per start_time in ascending order.    
+    """
+
+    # convert the distinct timestamps to datetime, events sharing a ts share a time row
+    t = pd.to_datetime(pd.Series(df["ts"].dropna().unique()).sort_values(ignore_index=True), unit='ms')
+
+    time_data = (t, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday)
+    column_labels = ('start_time','hour','day','week','month','year','weekday')
+    return pd.DataFrame(dict(zip(column_labels,time_data)))
+
+
+def load_song_index(cur):
+    """
+    Description: Loads the song lookup index used to resolve songplays in memory.
+
+    Reads every (title, artist name, duration) of the songs and artists tables once,
+    so log files no longer need a `song_select` query per event.
+
+    Arguments:
+        cur: the cursor object. 
+
+    Returns:
+        DataFrame with title, name, duration, song_id and artist_id columns, unique on
+        (title, name, duration).    
+    """
+    cur.execute(song_index_select)
+    song_index = pd.DataFrame(cur.fetchall(), columns=["title", "name", "duration", "song_id", "artist_id"])
+    song_index["duration"] = song_index["duration"].astype(float)
+
+    # keep a single match per key, like fetchone on song_select
+    return song_index.drop_duplicates(subset=["title", "name", "duration"])
+
+
+def resolve_songs(df, song_index):
+    """
+    Description: Adds song_id and artist_id columns to log events by a hash join on the song index.
+
+    Arguments:
+        df: log events DataFrame with song, artist and length columns. 
+        song_index: DataFrame returned by `load_song_index`. 
+
+    Returns:
+        Copy of df with song_id and artist_id columns, None where no song matched.    
+    """
+    resolved = df.merge(song_index, how='left',
+                        left_on=["song", "artist", "length"],
+                        right_on=["title", "name", "duration"])
+    resolved.index = df.index
+
+    ids = resolved[["song_id", "artist_id"]].astype(object)
+    return df.assign(song_id=ids["song_id"].where(ids["song_id"].notna(), None),
+                     artist_id=ids["artist_id"].where(ids["artist_id"].notna(), None))
+
+
+def compact_users(user_df):
+    """
+    Description: Collapses user records to the one of each user's latest event.
+
+    The upserts then write each user once instead of once per event. Users are returned
+    in user_id order, so concurrent loaders lock them in the same order.
+
+    Arguments:
+        user_df: DataFrame of user records with userId and ts columns. 
+
+    Returns:
+        DataFrame with one record per userId.    
+    """
+    return user_df.sort_values("ts", kind='mergesort') \
+        .drop_duplicates(subset="userId", keep='last') \
+        .sort_values("userId")
+
+
+def copy_df(cur, df, table):
+    """
+    Description: Streams a DataFrame into a table with COPY ... FROM STDIN.
+
+    Arguments:
+        cur: the cursor object. 
+        df: DataFrame whose column names match the table columns. 
+        table: name of the table to copy into. 
+
+    Returns:
+        None    
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert(staging_copy.format(table, ', '.join(df.columns)), buffer)
 
-def process_log_file(cur, filepath):
+
+@metrics.instrument()
+def process_log_file(cur, filepath, song_index=None):
     """
     Description: Processes a single log file.
     
@@ -38,6 +268,8 @@ def process_log_file(cur, filepath):
     Arguments:
         cur: the cursor object. 
         filepath: log data file path. 
+        song_index: optional song lookup index from `load_song_index`, queries
+            `song_select` per event when omitted. 
 
     Returns:
         None    
@@ -45,59 +277,213 @@ def process_log_file(cur, filepath):
     
     # open log file
     df = pd.read_json(filepath, lines=True)
+    num_events = len(df)
 
     # filter by NextSong action
     df = df[df['page'] == 'NextSong']
+    metrics.add(rows_read=num_events, rows_rejected=num_events - len(df), bytes_processed=os.path.getsize(filepath))
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df["ts"], unit='ms')
-    
-    # insert time data records
-    time_data = (t, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday)
-    column_labels = ('start_time','hour','day','week','month','year','weekday')
-    time_df = pd.DataFrame(dict(zip(column_labels,time_data)))
+    # create missing monthly songplays partitions before writing any rows
+    ensure_partitions(cur, pd.to_datetime(df["ts"], unit='ms'))
+
+    # insert one time record per distinct timestamp
+    time_df = get_time_df(df)
 
     for i, row in time_df.iterrows():
         cur.execute(time_table_insert, list(row))
 
-    # load user table
-    user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
+    # load user table, one row per user with the level of its latest event
+    user_df = compact_users(df[["userId", "firstName", "lastName", "gender", "level", "ts"]])
 
     # insert user records
     for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+        cur.execute(user_table_insert, list(row))
+
+    # get songid and artistid for all events at once from the song index
+    if song_index is not None:
+        df = resolve_songs(df, song_index)
 
     # insert songplay records
     for index, row in df.iterrows():
         
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
+        if song_index is not None:
+            songid, artistid = row.song_id, row.artist_id
         else:
-            songid, artistid = None, None
+            # get songid and artistid from song and artist tables
+            cur.execute(song_select, (row.song, row.artist, row.length))
+            results = cur.fetchone()
+            
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
 
         # insert songplay record
         songplay_data = (pd.to_datetime(row.ts, unit='ms'), row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
         cur.execute(songplay_table_insert, songplay_data)
 
+    metrics.add(rows_written=len(time_df) + len(user_df) + len(df))
 
-def process_data(cur, conn, filepath, func):
+
+@metrics.instrument()
+def process_log_file_bulk(cur, filepath, song_index=None):
     """
-    Description: Processes data depending on the given function.
-    
+    Description: Processes a single log file in bulk.
+
+    Copies the file's time, user and songplay rows into temporary staging tables
+    and fills the time, users and songplays tables with one set-based insert each,
+    keeping the conflict handling of the row by row inserts.
+
     Arguments:
         cur: the cursor object. 
-        conn:  the connection to the database.
         filepath: log data file path. 
-        func: the function to be used to process each log.
+        song_index: optional song lookup index from `load_song_index`, songplays are
+            resolved against songs and artists in the insert when omitted. 
+
+    Returns:
+        None    
+    """
+
+    # open log file
+    df = pd.read_json(filepath, lines=True)
+    num_events = len(df)
+
+    # filter by NextSong action
+    df = df[df['page'] == 'NextSong']
+    metrics.add(rows_read=num_events, rows_rejected=num_events - len(df), bytes_processed=os.path.getsize(filepath))
+
+    load_log_df_bulk(cur, df, song_index)
+
+
+def read_log_batches(filepath, batch_size=LOG_BATCH_SIZE):
+    """
+    Description: Reads a log file incrementally in batches of NextSong events.
+
+    Lines without NextSong are skipped before they are parsed, and at most `batch_size`
+    lines are held at a time, so memory does not grow with the file size. Batches are
+    parsed with `pd.read_json` like whole files are.
+
+    Arguments:
+        filepath: log data file path. 
+        batch_size: number of NextSong events per batch. 
+
+    Returns:
+        Generator of NextSong event DataFrames.    
+    """
+    lines = []
+    skipped = 0
+    with open(filepath, 'rb') as f:
+        for line in f:
+            if b'NextSong' not in line:
+                skipped += 1
+                continue
+            lines.append(line)
+            if len(lines) == batch_size:
+                yield parse_log_lines(lines)
+                lines = []
+    if lines:
+        yield parse_log_lines(lines)
+    metrics.add(rows_read=skipped, rows_rejected=skipped)
+
+
+def parse_log_lines(lines):
+    """
+    Description: Parses newline delimited log events and keeps the NextSong ones.
+
+    Arguments:
+        lines: list of JSON lines as bytes. 
+
+    Returns:
+        DataFrame of NextSong events.    
+    """
+    df = pd.read_json(io.BytesIO(b''.join(lines)), lines=True)
+    metrics.add(rows_read=len(df), rows_rejected=int((df['page'] != 'NextSong').sum()))
+    return df[df['page'] == 'NextSong']
+
+
+@metrics.instrument()
+def process_log_file_streaming(cur, filepath, song_index=None, batch_size=LOG_BATCH_SIZE):
+    """
+    Description: Processes a single log file in bulk, in fixed size batches of NextSong events.
+
+    For log files too large to load at once; all batches are written in the file's
+    transaction.
+
+    Arguments:
+        cur: the cursor object. 
+        filepath: log data file path. 
+        song_index: optional song lookup index from `load_song_index`. 
+        batch_size: number of NextSong events per batch. 
+
+    Returns:
+        None    
+    """
+    metrics.add(bytes_processed=os.path.getsize(filepath))
+    for i, df in enumerate(read_log_batches(filepath, batch_size)):
+        # only partitions of the first batch can be committed before the file's rows
+        load_log_df_bulk(cur, df, song_index, commit_partitions=(i == 0))
+
+
+def load_log_df_bulk(cur, df, song_index=None, commit_partitions=True):
+    """
+    Description: Loads NextSong events into time, users and songplays through the staging tables.
+
+    Arguments:
+        cur: the cursor object. 
+        df: NextSong events DataFrame. 
+        song_index: optional song lookup index from `load_song_index`, songplays are
+            resolved against songs and artists in the insert when omitted. 
+        commit_partitions: commit new songplays partitions right away, see `ensure_partitions`. 
 
     Returns:
         None    
     """
 
+    # create missing monthly songplays partitions before writing any rows
+    ensure_partitions(cur, pd.to_datetime(df["ts"], unit='ms'), commit=commit_partitions)
+
+    # (re)create and empty the staging tables of this session
+    for query in staging_table_queries:
+        cur.execute(query)
+    cur.execute(staging_truncate)
+
+    # stage time data records
+    copy_df(cur, get_time_df(df), 'time_staging')
+
+    # stage one user record per user, keeping ts so the latest level wins
+    user_df = compact_users(df[["userId", "firstName", "lastName", "gender", "level", "ts"]]) \
+        .set_axis(["user_id", "first_name", "last_name", "gender", "level", "ts"], axis=1)
+    copy_df(cur, user_df, 'user_staging')
+
+    # stage songplay records, song and artist ids are resolved in the insert
+    songplay_df = df[["ts", "userId", "level", "song", "artist", "length", "sessionId", "location", "userAgent"]] \
+        .set_axis(["start_time", "user_id", "level", "song", "artist", "length", "session_id", "location", "user_agent"], axis=1)
+    songplay_df["start_time"] = pd.to_datetime(songplay_df["start_time"], unit='ms')
+    if song_index is not None:
+        songplay_df = resolve_songs(songplay_df, song_index)
+    copy_df(cur, songplay_df, 'songplay_staging')
+
+    cur.execute(time_table_bulk_insert)
+    cur.execute(user_table_bulk_insert)
+    if song_index is not None:
+        cur.execute(songplay_table_bulk_insert_resolved)
+    else:
+        cur.execute(songplay_table_bulk_insert)
+
+    metrics.add(rows_written=len(df) * 2 + len(user_df))
+
+
+def get_files(filepath):
+    """
+    Description: Lists all JSON files under a directory.
+
+    Arguments:
+        filepath: data directory. 
+
+    Returns:
+        List of absolute file paths.    
+    """
+
     # get all files matching extension from directory
     all_files = []
     for root, dirs, files in os.walk(filepath):
@@ -105,15 +491,257 @@ def process_data(cur, conn, filepath, func):
         for f in files :
             all_files.append(os.path.abspath(f))
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    return all_files
+
+
+@metrics.instrument()
+def run_index_queries(cur, conn, queries):
+    """
+    Description: Creates or drops secondary indexes.
+
+    Used around large loads so rows are not indexed one at a time: the indexes are
+    dropped before loading and built in one pass, followed by ANALYZE, afterwards.
+
+    Arguments:
+        cur: the cursor object. 
+        conn:  the connection to the database.
+        queries: index queries from `sql_queries`. 
+
+    Returns:
+        None    
+    """
+    for query in queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def get_file_hash(filepath):
+    """
+    Description: Computes the SHA-256 hex digest of a file's content.
+
+    Arguments:
+        filepath: data file path. 
+
+    Returns:
+        Hex digest string.    
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_new_files(cur, all_files):
+    """
+    Description: Selects the files that are missing from or changed since the ingestion manifest.
+
+    Files whose size and mtime match the manifest are skipped without being read. Files
+    whose size or mtime changed but whose content hash did not are skipped as well, and
+    their new size and mtime are recorded on the cursor's transaction.
+
+    Note that a changed file is loaded again as a whole, so rows it contributed before
+    are not removed from the fact table.
+
+    Arguments:
+        cur: the cursor object. 
+        all_files: data file paths. 
+
+    Returns:
+        List of (path, size, mtime, content_hash) manifest entries of the files to process.    
+    """
+    cur.execute(ingested_files_select)
+    manifest = dict((row[0], row[1:]) for row in cur.fetchall())
+
+    new_files, touched_files = [], []
+    for datafile in all_files:
+        stat = os.stat(datafile)
+        known = manifest.get(datafile)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            continue
+
+        entry = (datafile, stat.st_size, stat.st_mtime, get_file_hash(datafile))
+        if known and known[2] == entry[3]:
+            touched_files.append(entry)
+        else:
+            new_files.append(entry)
+
+    record_files(cur, touched_files)
+    print('{} of {} files are new or changed.'.format(len(new_files), len(all_files)))
+    return new_files
+
+
+def record_files(cur, entries):
+    """
+    Description: Records files as ingested in the manifest.
+
+    Arguments:
+        cur: the cursor object. 
+        entries: (path, size, mtime, content_hash) manifest entries. 
+
+    Returns:
+        None    
+    """
+    if entries:
+        execute_values(cur, ingested_file_upsert, entries)
+
+
+def get_stage_name(filepath):
+    """
+    Description: Names the metrics stage of loading a data directory, e.g. process_data.song_data.
+
+    Arguments:
+        filepath: data directory. 
+
+    Returns:
+        Stage name.    
+    """
+    return 'process_data.{}'.format(os.path.basename(os.path.normpath(filepath)))
+
+
+def process_data(cur, conn, filepath, func, incremental=False):
+    """
+    Description: Processes data depending on the given function.
+    
+    Arguments:
+        cur: the cursor object. 
+        conn:  the connection to the database.
+        filepath: log data file path. 
+        func: the function to be used to process each log.
+        incremental: only process files missing from or changed since the ingestion manifest,
+            recording each file in the transaction of its data.
+
+    Returns:
+        None    
+    """
+
+    with metrics.stage(get_stage_name(filepath)):
+        all_files = get_files(filepath)
+        entries = [(datafile, None) for datafile in all_files]
+        if incremental:
+            entries = [(entry[0], entry) for entry in get_new_files(cur, all_files)]
+            conn.commit()
+
+        # get total number of files found
+        num_files = len(entries)
+        print('{} files found in {}'.format(num_files, filepath))
+
+        # iterate over files and process
+        for i, (datafile, entry) in enumerate(entries, 1):
+            func(cur, datafile)
+            if entry:
+                record_files(cur, [entry])
+            conn.commit()
+            print('{}/{} files processed.'.format(i, num_files))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+
+def init_worker(dsn, func):
+    """
+    Description: Initializes a worker process of the parallel loader.
+
+    Opens the worker's connection pool and keeps the file function, so it is sent
+    to each worker once instead of with every file.
+
+    Arguments:
+        dsn: connection string of the database. 
+        func: the function to be used to process each file.
+
+    Returns:
+        None    
+    """
+    global worker_pool, worker_func
+
+    worker_pool = pool.SimpleConnectionPool(1, 1, dsn, cursor_factory=CountingCursor)
+    worker_func = func
+
+    # forked workers start with a copy of the parent's metrics
+    metrics.drain()
+
+    # close the pooled connection when the worker exits
+    Finalize(worker_pool, worker_pool.closeall, exitpriority=10)
+
+
+def process_file(task):
+    """
+    Description: Processes one file in a worker process and commits it.
+
+    The file is retried when its transaction deadlocks with another worker.
+
+    Arguments:
+        task: (data file path, manifest entry or None) tuple. 
+
+    Returns:
+        (processed file path, the worker's metrics of the file) tuple.    
+    """
+    datafile, entry = task
+    conn = worker_pool.getconn()
+    try:
+        with metrics.stage('process_file'):
+            for attempt in range(1, MAX_FILE_ATTEMPTS + 1):
+                try:
+                    with conn.cursor() as cur:
+                        worker_func(cur, datafile)
+                        if entry:
+                            record_files(cur, [entry])
+                    conn.commit()
+                    break
+                except errors.DeadlockDetected:
+                    conn.rollback()
+                    if attempt == MAX_FILE_ATTEMPTS:
+                        raise
+    finally:
+        worker_pool.putconn(conn)
+
+    return datafile, metrics.drain()
+
+
+def process_data_parallel(filepath, func, workers, dsn=DSN, incremental=False):
+    """
+    Description: Processes data depending on the given function with a pool of worker processes.
+
+    Each worker has its own pooled connection and commits every file it processes.
+    Returns only when all files are done, so loads can be ordered by calling it in sequence.
+
+    Arguments:
+        filepath: data directory. 
+        func: the function to be used to process each file, must be picklable.
+        workers: number of worker processes. 
+        dsn: connection string of the database. 
+        incremental: only process files missing from or changed since the ingestion manifest,
+            recording each file in the transaction of its data.
+
+    Returns:
+        None    
+    """
+
+    with metrics.stage(get_stage_name(filepath)):
+        all_files = get_files(filepath)
+        tasks = [(datafile, None) for datafile in all_files]
+        if incremental:
+            conn = psycopg2.connect(dsn, cursor_factory=CountingCursor)
+            try:
+                with conn.cursor() as cur:
+                    tasks = [(entry[0], entry) for entry in get_new_files(cur, all_files)]
+                conn.commit()
+            finally:
+                conn.close()
+
+        # get total number of files found
+        num_files = len(tasks)
+        print('{} files found in {}'.format(num_files, filepath))
+
+        workers_pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(dsn, func))
+        try:
+            chunksize = max(1, num_files // (workers * 16))
+            for i, (datafile, file_metrics) in enumerate(workers_pool.imap_unordered(process_file, tasks, chunksize), 1):
+                metrics.merge(file_metrics)
+                print('{}/{} files processed.'.format(i, num_files))
+            workers_pool.close()
+        except BaseException:
+            workers_pool.terminate()
+            raise
+        finally:
+            workers_pool.join()
 
 
 def main():
@@ -126,13 +754,74 @@ def main():
         None    
     """
 
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    parser = argparse.ArgumentParser(description='Load the song and log data into sparkifydb.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='load log files through COPY staging tables instead of row by row inserts')
+    parser.add_argument('--stream', action='store_true',
+                        help='load log files in bulk, reading them in batches of {} NextSong events'.format(LOG_BATCH_SIZE))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each with its own connection (default: 1)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip files that are unchanged since they were recorded in the ingestion manifest')
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help='drop secondary indexes before loading and rebuild them after each load')
+    parser.add_argument('--song-batch', action='store_true',
+                        help='load song files in batches of {} with one insert per table'.format(SONG_BATCH_SIZE))
+    parser.add_argument('--song-select', action='store_true',
+                        help='look songs up with a song_select query per event instead of the song index')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN, cursor_factory=CountingCursor)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='../../data/external/data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='../../data/external/data/log_data', func=process_log_file)
+    if args.stream:
+        log_func = process_log_file_streaming
+    elif args.bulk:
+        log_func = process_log_file_bulk
+    else:
+        log_func = process_log_file
+
+    if args.defer_indexes:
+        run_index_queries(cur, conn, lookup_index_drop_queries + songplay_index_drop_queries)
+
+    # songs and artists are fully loaded before any log file is processed
+    if args.song_batch:
+        process_song_data_batch(cur, conn, filepath='../../data/external/data/song_data', incremental=args.incremental)
+    elif args.workers > 1:
+        process_data_parallel(filepath='../../data/external/data/song_data', func=process_song_file, workers=args.workers,
+                              incremental=args.incremental)
+    else:
+        process_data(cur, conn, filepath='../../data/external/data/song_data', func=process_song_file,
+                     incremental=args.incremental)
+
+    # log files look songs up by title, artist name and duration
+    if args.defer_indexes:
+        run_index_queries(cur, conn, lookup_index_create_queries)
+
+    # build the song lookup index once, after all songs and artists are loaded
+    if not args.song_select:
+        with metrics.stage('load_song_index'):
+            song_index = load_song_index(cur)
+            conn.commit()
+        log_func = partial(log_func, song_index=song_index)
+
+    if args.workers > 1:
+        process_data_parallel(filepath='../../data/external/data/log_data', func=log_func, workers=args.workers,
+                              incremental=args.incremental)
+    else:
+        process_data(cur, conn, filepath='../../data/external/data/log_data', func=log_func,
+                     incremental=args.incremental)
+
+    if args.defer_indexes:
+        run_index_queries(cur, conn, songplay_index_create_queries)
+
+    # aggregate the songplays of this run into the rollup tables
+    with metrics.stage('refresh_rollups'):
+        refresh_rollups(cur, conn)
 
     conn.close()
 
+    print('Metrics written to {} and {}.'.format(*metrics.write('data_model_postgres_etl')))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,137 @@
+import argparse
+import psycopg2
+from psycopg2 import errors
+import pandas as pd
+from sql_queries import *
+
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+def get_partition_name(month):
+    """
+    Description: Names the songplays partition of a month.
+
+    Arguments:
+        month: pandas monthly Period.
+
+    Returns:
+        Partition table name, e.g. songplays_2018_11.
+    """
+    return 'songplays_{}'.format(month.strftime('%Y_%m'))
+
+
+def get_partitions(cur):
+    """
+    Description: Lists the partitions attached to songplays.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        Set of partition table names, empty when songplays is not partitioned.
+    """
+    cur.execute(songplay_partitions_select)
+    return set(row[0] for row in cur.fetchall())
+
+
+def ensure_partitions(cur, start_times, commit=True):
+    """
+    Description: Creates the missing monthly songplays partitions for the given start times.
+
+    Does nothing when songplays is not partitioned. New partitions are committed right
+    away, so call it before writing any rows of the current file; concurrent loaders
+    creating the same partition are tolerated.
+
+    Arguments:
+        cur: the cursor object.
+        start_times: Series of songplay start times.
+        commit: commit new partitions; without it they stay in the current transaction,
+            locking songplays until it ends.
+
+    Returns:
+        None
+    """
+    cur.execute(songplay_partitioned_select)
+    if not cur.fetchone()[0]:
+        return
+
+    existing = get_partitions(cur)
+    created = False
+    for month in pd.Series(start_times).dt.to_period('M').dropna().unique():
+        name = get_partition_name(month)
+        if name in existing:
+            continue
+
+        cur.execute("savepoint create_partition")
+        try:
+            cur.execute(songplay_partition_create.format(name),
+                        (month.start_time.to_pydatetime(), (month + 1).start_time.to_pydatetime()))
+        except (errors.DuplicateTable, errors.UniqueViolation):
+            # another loader created it first
+            cur.execute("rollback to savepoint create_partition")
+        created = True
+
+    if created and commit:
+        cur.connection.commit()
+
+
+def detach_partitions(conn, before, action='detach'):
+    """
+    Description: Detaches the songplays partitions of months before the given month.
+
+    Partitions are detached concurrently, so loads and queries on songplays keep running.
+    Detached partitions are kept as standalone tables, moved to the songplays_archive
+    schema or dropped.
+
+    Arguments:
+        conn:  the connection to the database, switched to autocommit.
+        before: first month to keep, e.g. '2019-01'.
+        action: 'detach', 'archive' or 'drop'.
+
+    Returns:
+        List of the detached partition names.
+    """
+
+    # detach concurrently cannot run inside a transaction block
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+
+    cutoff = get_partition_name(pd.Period(before, freq='M'))
+    detached = sorted(name for name in get_partitions(cur) if name < cutoff)
+
+    if action == 'archive':
+        cur.execute(songplay_archive_schema_create)
+    for name in detached:
+        cur.execute(songplay_partition_detach.format(name))
+        if action == 'archive':
+            cur.execute(songplay_partition_archive.format(name))
+        elif action == 'drop':
+            cur.execute(songplay_partition_drop.format(name))
+        print('{} detached{}.'.format(name, {'archive': ' and archived', 'drop': ' and dropped'}.get(action, '')))
+
+    return detached
+
+
+def main():
+    """
+    Description: Detaches, archives or drops old songplays partitions.
+
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Retire old months of the partitioned songplays table.')
+    parser.add_argument('before', help='first month to keep, e.g. 2019-01')
+    parser.add_argument('--action', choices=('detach', 'archive', 'drop'), default='detach',
+                        help='keep detached partitions as tables, move them to the songplays_archive schema '
+                             'or drop them (default: detach)')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    detach_partitions(conn, args.before, args.action)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import psycopg2
+from sql_queries import *
+
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+def refresh_rollups(cur, conn):
+    """
+    Description: Adds the songplays inserted since the last refresh to the rollup tables.
+
+    Only songplays with a songplay_id above the watermark in rollup_state are aggregated,
+    and the rollups and the watermark are updated in one transaction. Run it once the
+    loaders of a run have committed, as rows of still running loads may have lower ids.
+
+    Arguments:
+        cur: the cursor object.
+        conn:  the connection to the database.
+
+    Returns:
+        Number of songplay ids covered by this refresh.
+    """
+    cur.execute(rollup_state_init)
+
+    # lock the watermark, so concurrent refreshes cannot count rows twice
+    cur.execute(rollup_state_select)
+    last_songplay_id = cur.fetchone()[0]
+    cur.execute(songplay_max_id_select)
+    max_songplay_id = cur.fetchone()[0]
+
+    if max_songplay_id > last_songplay_id:
+        for query in rollup_upsert_queries:
+            cur.execute(query, (last_songplay_id, max_songplay_id))
+        cur.execute(rollup_state_update, (max_songplay_id,))
+    conn.commit()
+
+    return max_songplay_id - last_songplay_id
+
+
+def rebuild_rollups(cur, conn):
+    """
+    Description: Recomputes the rollup tables from all songplays.
+
+    Arguments:
+        cur: the cursor object.
+        conn:  the connection to the database.
+
+    Returns:
+        None
+    """
+    cur.execute(rollup_state_init)
+    cur.execute(rollup_state_select)
+    cur.execute(rollup_truncate)
+    cur.execute(rollup_state_update, (0,))
+    refresh_rollups(cur, conn)
+
+
+def main():
+    """
+    Description: Refreshes or rebuilds the songplays rollup tables.
+
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Maintain the songplays rollup tables.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='recompute the rollups from all songplays instead of the new ones only')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor()
+
+    if args.rebuild:
+        rebuild_rollups(cur, conn)
+    else:
+        print('{} songplay ids added to the rollups.'.format(refresh_rollups(cur, conn)))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
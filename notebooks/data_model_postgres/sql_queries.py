@@ -4,6 +4,11 @@ user_table_drop = "drop table if exists users"
 song_table_drop = "drop table if exists songs"
 artist_table_drop = "drop table if exists artists"
 time_table_drop = "drop table if exists time"
+ingested_files_table_drop = "drop table if exists ingested_files"
+songplays_by_hour_table_drop = "drop table if exists songplays_by_hour"
+songplays_by_user_day_table_drop = "drop table if exists songplays_by_user_day"
+songplays_by_level_location_table_drop = "drop table if exists songplays_by_level_location"
+rollup_state_table_drop = "drop table if exists rollup_state"
 
 # Create tables
 songplay_table_create = ("""
@@ -19,13 +24,30 @@ songplay_table_create = ("""
         user_agent varchar)
 """)
 
+# songplays range partitioned by month of start_time, partitions are created by the ETL
+songplay_table_create_partitioned = ("""
+    create table if not exists songplays (
+        songplay_id serial, 
+        start_time timestamp not null, 
+        user_id int not null, 
+        level varchar,
+        song_id varchar, 
+        artist_id varchar, 
+        session_id int, 
+        location varchar, 
+        user_agent varchar, 
+        primary key (songplay_id, start_time))
+    partition by range (start_time)
+""")
+
 user_table_create = ("""
     create table if not exists users (
         user_id int primary key, 
         first_name varchar, 
         last_name varchar, 
         gender varchar, 
-        level varchar)
+        level varchar, 
+        level_ts bigint)
 """)
 
 song_table_create = ("""
@@ -57,18 +79,94 @@ time_table_create = ("""
         weekday varchar)
 """)
 
+ingested_files_table_create = ("""
+    create table if not exists ingested_files (
+        path varchar primary key, 
+        size bigint not null, 
+        mtime double precision not null, 
+        content_hash varchar not null, 
+        loaded_at timestamp not null default now())
+""")
+
+# Rollup tables, maintained by the ETL from the songplays added since last_songplay_id
+songplays_by_hour_table_create = ("""
+    create table if not exists songplays_by_hour (
+        hour timestamp primary key, 
+        plays bigint not null)
+""")
+
+songplays_by_user_day_table_create = ("""
+    create table if not exists songplays_by_user_day (
+        user_id int, 
+        day date, 
+        plays bigint not null, 
+        primary key (user_id, day))
+""")
+
+songplays_by_level_location_table_create = ("""
+    create table if not exists songplays_by_level_location (
+        level varchar, 
+        location varchar, 
+        plays bigint not null, 
+        primary key (level, location))
+""")
+
+rollup_state_table_create = ("""
+    create table if not exists rollup_state (
+        rollup varchar primary key, 
+        last_songplay_id bigint not null)
+""")
+
+# songplays partitions
+songplay_partitioned_select = ("""
+    select count(*) > 0
+    from pg_partitioned_table
+    where partrelid = to_regclass('songplays')
+""")
+
+songplay_partitions_select = ("""
+    select inhrelid::regclass::text
+    from pg_inherits
+    where inhparent = to_regclass('songplays')
+""")
+
+songplay_partition_create = ("""
+    create table if not exists {} partition of songplays 
+    for values from (%s) to (%s)
+""")
+
+songplay_partition_detach = "alter table songplays detach partition {} concurrently"
+songplay_archive_schema_create = "create schema if not exists songplays_archive"
+songplay_partition_archive = "alter table {} set schema songplays_archive"
+songplay_partition_drop = "drop table if exists {}"
+
+# Create indexes
+song_lookup_index_create = "create index if not exists songs_title_duration_idx on songs (title, duration)"
+artist_lookup_index_create = "create index if not exists artists_name_idx on artists (name)"
+songplay_start_time_index_create = "create index if not exists songplays_start_time_idx on songplays (start_time)"
+songplay_session_index_create = "create index if not exists songplays_user_session_idx on songplays (user_id, session_id)"
+
+# Drop indexes
+song_lookup_index_drop = "drop index if exists songs_title_duration_idx"
+artist_lookup_index_drop = "drop index if exists artists_name_idx"
+songplay_start_time_index_drop = "drop index if exists songplays_start_time_idx"
+songplay_session_index_drop = "drop index if exists songplays_user_session_idx"
+
 # Insert records
 songplay_table_insert = ("""
     insert into songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) 
     values (%s, %s, %s, %s, %s, %s, %s, %s) 
-    on conflict (songplay_id) do nothing
+    on conflict do nothing
 """)
 
+# level_ts is the ts of the event level was taken from, an older event never overwrites a newer level
 user_table_insert = ("""
-    insert into users (user_id, first_name, last_name, gender, level) 
-    values (%s, %s, %s, %s, %s)
+    insert into users (user_id, first_name, last_name, gender, level, level_ts) 
+    values (%s, %s, %s, %s, %s, %s)
     on conflict (user_id) do update set 
-    level = excluded.level 
+    level = excluded.level, 
+    level_ts = excluded.level_ts 
+    where users.level_ts is null or users.level_ts <= excluded.level_ts
 """)
 
 song_table_insert = ("""
@@ -83,6 +181,18 @@ artist_table_insert = ("""
     on conflict (artist_id) do nothing
 """)
 
+# Batch insert records, values expanded by psycopg2.extras.execute_values
+song_table_batch_insert = ("""
+    insert into songs (song_id, title, artist_id, year, duration)
+    values %s
+    on conflict (song_id) do nothing
+""")
+
+artist_table_batch_insert = ("""
+    insert into artists (artist_id, name, location, latitude, longitude)
+    values %s
+    on conflict (artist_id) do nothing
+""")
 
 time_table_insert = ("""
     insert into time (start_time, hour, day, week, month, year, weekday)
@@ -100,6 +210,184 @@ song_select = ("""
     and songs.duration = %s
 """)
 
+# Ingestion manifest, written in the same transaction as the file's data
+ingested_files_select = ("""
+    select path, size, mtime, content_hash
+    from ingested_files
+""")
+
+ingested_file_upsert = ("""
+    insert into ingested_files (path, size, mtime, content_hash)
+    values %s
+    on conflict (path) do update set 
+    size = excluded.size, 
+    mtime = excluded.mtime, 
+    content_hash = excluded.content_hash, 
+    loaded_at = now()
+""")
+
+# Rollup maintenance, each upsert adds the plays of songplay_id in (%s, %s]
+rollup_state_init = ("""
+    insert into rollup_state (rollup, last_songplay_id)
+    values ('songplays', 0)
+    on conflict (rollup) do nothing
+""")
+
+rollup_state_select = "select last_songplay_id from rollup_state where rollup = 'songplays' for update"
+rollup_state_update = "update rollup_state set last_songplay_id = %s where rollup = 'songplays'"
+songplay_max_id_select = "select coalesce(max(songplay_id), 0) from songplays"
+
+songplays_by_hour_upsert = ("""
+    insert into songplays_by_hour (hour, plays)
+    select date_trunc('hour', start_time), count(*)
+    from songplays
+    where songplay_id > %s and songplay_id <= %s
+    group by 1
+    on conflict (hour) do update set 
+    plays = songplays_by_hour.plays + excluded.plays
+""")
+
+songplays_by_user_day_upsert = ("""
+    insert into songplays_by_user_day (user_id, day, plays)
+    select user_id, start_time::date, count(*)
+    from songplays
+    where songplay_id > %s and songplay_id <= %s
+    group by 1, 2
+    on conflict (user_id, day) do update set 
+    plays = songplays_by_user_day.plays + excluded.plays
+""")
+
+songplays_by_level_location_upsert = ("""
+    insert into songplays_by_level_location (level, location, plays)
+    select coalesce(level, ''), coalesce(location, ''), count(*)
+    from songplays
+    where songplay_id > %s and songplay_id <= %s
+    group by 1, 2
+    on conflict (level, location) do update set 
+    plays = songplays_by_level_location.plays + excluded.plays
+""")
+
+rollup_truncate = "truncate songplays_by_hour, songplays_by_user_day, songplays_by_level_location"
+
+# Song lookup index, loaded once per run to resolve songplays in memory
+song_index_select = ("""
+    select songs.title, artists.name, songs.duration, songs.song_id, artists.artist_id
+    from songs 
+    join artists on songs.artist_id = artists.artist_id
+""")
+
+# Bulk load staging tables (session-local, filled with COPY ... FROM STDIN)
+time_staging_create = ("""
+    create temporary table if not exists time_staging (
+        start_time timestamp, 
+        hour int, 
+        day int, 
+        week int, 
+        month int, 
+        year int, 
+        weekday varchar)
+""")
+
+user_staging_create = ("""
+    create temporary table if not exists user_staging (
+        user_id int, 
+        first_name varchar, 
+        last_name varchar, 
+        gender varchar, 
+        level varchar, 
+        ts bigint)
+""")
+
+songplay_staging_create = ("""
+    create temporary table if not exists songplay_staging (
+        start_time timestamp, 
+        user_id int, 
+        level varchar, 
+        song varchar, 
+        artist varchar, 
+        length decimal, 
+        song_id varchar, 
+        artist_id varchar, 
+        session_id int, 
+        location varchar, 
+        user_agent varchar)
+""")
+
+song_staging_create = "create temporary table if not exists song_staging (like songs)"
+artist_staging_create = "create temporary table if not exists artist_staging (like artists)"
+
+staging_truncate = "truncate time_staging, user_staging, songplay_staging"
+song_staging_truncate = "truncate song_staging, artist_staging"
+
+staging_copy = "copy {} ({}) from stdin with (format csv)"
+
+# Bulk insert records from staging, same conflict handling as the row inserts
+time_table_bulk_insert = ("""
+    insert into time (start_time, hour, day, week, month, year, weekday)
+    select start_time, hour, day, week, month, year, weekday
+    from time_staging
+    order by start_time
+    on conflict (start_time) do nothing
+""")
+
+user_table_bulk_insert = ("""
+    insert into users (user_id, first_name, last_name, gender, level, level_ts)
+    select distinct on (user_id) user_id, first_name, last_name, gender, level, ts
+    from user_staging
+    order by user_id, ts desc
+    on conflict (user_id) do update set 
+    level = excluded.level, 
+    level_ts = excluded.level_ts 
+    where users.level_ts is null or users.level_ts <= excluded.level_ts
+""")
+
+songplay_table_bulk_insert = ("""
+    insert into songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) 
+    select sp.start_time, sp.user_id, sp.level, s.song_id, s.artist_id, sp.session_id, sp.location, sp.user_agent
+    from songplay_staging sp
+    left join lateral (
+        select songs.song_id, artists.artist_id
+        from songs 
+        join artists on songs.artist_id = artists.artist_id
+        where songs.title = sp.song
+        and artists.name = sp.artist
+        and songs.duration = sp.length
+        limit 1) s on true
+    on conflict do nothing
+""")
+
+song_table_bulk_insert = ("""
+    insert into songs (song_id, title, artist_id, year, duration)
+    select song_id, title, artist_id, year, duration
+    from song_staging
+    on conflict (song_id) do nothing
+""")
+
+artist_table_bulk_insert = ("""
+    insert into artists (artist_id, name, location, latitude, longitude)
+    select artist_id, name, location, latitude, longitude
+    from artist_staging
+    on conflict (artist_id) do nothing
+""")
+
+songplay_table_bulk_insert_resolved = ("""
+    insert into songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) 
+    select start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+    from songplay_staging
+    on conflict do nothing
+""")
+
 # DML lists
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, ingested_files_table_create,
+                        songplays_by_hour_table_create, songplays_by_user_day_table_create, songplays_by_level_location_table_create, rollup_state_table_create]
+create_partitioned_table_queries = [songplay_table_create_partitioned] + create_table_queries[1:]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, ingested_files_table_drop,
+                      songplays_by_hour_table_drop, songplays_by_user_day_table_drop, songplays_by_level_location_table_drop, rollup_state_table_drop]
+staging_table_queries = [time_staging_create, user_staging_create, songplay_staging_create]
+song_staging_table_queries = [song_staging_create, artist_staging_create]
+lookup_index_create_queries = [song_lookup_index_create, artist_lookup_index_create, "analyze songs", "analyze artists"]
+lookup_index_drop_queries = [song_lookup_index_drop, artist_lookup_index_drop]
+songplay_index_create_queries = [songplay_start_time_index_create, songplay_session_index_create, "analyze songplays"]
+songplay_index_drop_queries = [songplay_start_time_index_drop, songplay_session_index_drop]
+create_index_queries = lookup_index_create_queries + songplay_index_create_queries
+rollup_upsert_queries = [songplays_by_hour_upsert, songplays_by_user_day_upsert, songplays_by_level_location_upsert]
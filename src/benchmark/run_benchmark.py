@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+import click
+import glob
+import importlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+NOTEBOOKS_DIR = PROJECT_DIR / 'notebooks'
+
+# flat modules shared by name between the pipeline directories
+PIPELINE_MODULES = ('etl', 'sql_queries', 'create_tables', 'rehearsal')
+
+POSTGRES_MODES = ('select', 'row', 'bulk', 'parallel')
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def pipeline(name):
+    """ Makes the flat modules of notebooks/<name> importable and runs in that
+        directory, as the pipeline scripts read their config from the working
+        directory.
+    """
+    directory = str(NOTEBOOKS_DIR / name)
+    cwd = os.getcwd()
+    for module in PIPELINE_MODULES:
+        sys.modules.pop(module, None)
+    sys.path.insert(0, directory)
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(directory)
+
+
+@contextmanager
+def stage(results, engine, mode, name):
+    """ Times the enclosed block and appends it to results as one stage
+        record.
+    """
+    logger.info('{} ({}): {}'.format(engine, mode, name))
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    results.append({'engine': engine, 'mode': mode, 'stage': name,
+                    'seconds': round(seconds, 6)})
+    logger.info('{} ({}): {} took {:.3f}s'.format(
+        engine, mode, name, seconds))
+
+
+def describe_input(data_dir):
+    """ Returns the size of the generated input: file counts and events per
+        kind.
+    """
+    song_files = glob.glob(
+        os.path.join(data_dir, 'song_data', '*', '*', '*', '*.json'))
+    log_files = glob.glob(os.path.join(data_dir, 'log_data', '*.json'))
+    events = next_song_events = 0
+    for log_file in log_files:
+        with open(log_file) as f:
+            for line in f:
+                events += 1
+                next_song_events += '"page":"NextSong"' in line
+    return {'song_files': len(song_files), 'log_files': len(log_files),
+            'events': events, 'next_song_events': next_song_events,
+            'bytes': sum(os.path.getsize(f) for f in song_files + log_files)}
+
+
+def run_postgres(data_dir, mode, workers, results, row_counts):
+    """ Recreates sparkifydb and loads the data with data_model_postgres/etl.py
+        in the given mode.
+    """
+    with pipeline('data_model_postgres'):
+        create_tables = importlib.import_module('create_tables')
+        etl = importlib.import_module('etl')
+        song_dir = os.path.join(data_dir, 'song_data')
+        log_dir = os.path.join(data_dir, 'log_data')
+
+        with stage(results, 'postgres', mode, 'create_tables'):
+            cur, conn = create_tables.create_database()
+            create_tables.create_tables(cur, conn)
+
+        with stage(results, 'postgres', mode, 'song_data'):
+            if mode in ('select', 'row'):
+                etl.process_data(cur, conn, song_dir, etl.process_song_file)
+            else:
+                etl.process_song_data_batch(cur, conn, song_dir)
+
+        # the select mode is the row by row baseline, one song_select per event
+        song_index = None
+        if mode != 'select':
+            with stage(results, 'postgres', mode, 'song_index'):
+                song_index = etl.load_song_index(cur)
+                conn.commit()
+
+        with stage(results, 'postgres', mode, 'log_data'):
+            if mode in ('select', 'row'):
+                etl.process_data(cur, conn, log_dir, partial(
+                    etl.process_log_file, song_index=song_index))
+            elif mode == 'bulk':
+                etl.process_data(cur, conn, log_dir, partial(
+                    etl.process_log_file_bulk, song_index=song_index))
+            else:
+                etl.process_data_parallel(log_dir, partial(
+                    etl.process_log_file_bulk, song_index=song_index),
+                    workers)
+
+        counts = {}
+        for table in ('songplays', 'users', 'songs', 'artists', 'time'):
+            cur.execute('select count(*) from {}'.format(table))
+            counts[table] = cur.fetchone()[0]
+        row_counts['postgres/' + mode] = counts
+        conn.close()
+
+
+def run_redshift(results, row_counts):
+    """ Recreates and loads the cluster configured in
+        cloud_warehouse_aws/dwh.cfg from the S3 paths in that file, so the
+        generated data has to be synced to S3 first.
+    """
+    with pipeline('cloud_warehouse_aws'):
+        import configparser
+        import psycopg2
+
+        create_tables = importlib.import_module('create_tables')
+        etl = importlib.import_module('etl')
+
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        conn = psycopg2.connect(
+            "host={} dbname={} user={} password={} port={}".format(
+                *config['CLUSTER'].values()))
+        cur = conn.cursor()
+
+        with stage(results, 'redshift', 'cluster', 'create_tables'):
+            create_tables.drop_tables(cur, conn)
+            create_tables.create_tables(cur, conn)
+        with stage(results, 'redshift', 'cluster', 'load_staging_tables'):
+            etl.load_staging_tables(cur, conn)
+        with stage(results, 'redshift', 'cluster', 'insert_tables'):
+            etl.insert_tables(cur, conn)
+
+        counts = {}
+        for table in ('songplays', 'users', 'songs', 'artists', 'time'):
+            cur.execute('select count(*) from {}'.format(table))
+            counts[table] = cur.fetchone()[0]
+        row_counts['redshift/cluster'] = counts
+        conn.close()
+
+
+def run_rehearsal(data_dir, results, row_counts):
+    """ Runs the Redshift statements of cloud_warehouse_aws on the local
+        rehearsal database, loading DATA_DIR in place of the S3 data.
+    """
+    with pipeline('cloud_warehouse_aws'):
+        create_tables = importlib.import_module('create_tables')
+        etl = importlib.import_module('etl')
+        rehearsal = importlib.import_module('rehearsal')
+
+        rehearsal.create_database()
+        connections = [rehearsal.connect(rehearsal.DSN, data_dir)
+                       for _ in range(etl.CONCURRENCY)]
+        conn = connections[0]
+        cur = conn.cursor()
+
+        with stage(results, 'redshift', 'rehearsal', 'create_tables'):
+            create_tables.drop_tables(cur, conn)
+            create_tables.create_tables(cur, conn)
+        with stage(results, 'redshift', 'rehearsal', 'load_staging_tables'):
+            etl.load_staging_tables(cur, conn, connections)
+        with stage(results, 'redshift', 'rehearsal', 'insert_tables'):
+            etl.insert_tables(cur, conn, connections)
+
+        counts = {}
+        for table in ('songplays', 'users', 'songs', 'artists', 'time'):
+            cur.execute('select count(*) from {}'.format(table))
+            counts[table] = cur.fetchone()[0]
+        row_counts['redshift/rehearsal'] = counts
+        for connection in connections:
+            connection.close()
+
+
+def run_spark(data_dir, output_dir, results, row_counts):
+    """ Runs data_lake_spark/etl.py on a local mode Spark session, writing
+        parquet to output_dir.
+    """
+    with pipeline('data_lake_spark'):
+        from pyspark.sql import SparkSession
+
+        etl = importlib.import_module('etl')
+        spark = SparkSession.builder.master('local[*]') \
+            .appName('sparkify-benchmark').getOrCreate()
+        song_glob = os.path.join(
+            data_dir, 'song_data', '*', '*', '*', '*.json')
+        log_glob = os.path.join(data_dir, 'log_data', '*.json')
+        output_data = output_dir.rstrip('/') + '/'
+        run_start_time = datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')
+
+        with stage(results, 'spark', 'local', 'load_song_data'):
+            song_df = etl.load_song_data(
+                spark, song_glob, output_data, run_start_time)
+        with stage(results, 'spark', 'local', 'process_song_data'):
+            songs_table, artists_table = etl.process_song_data(
+                spark, song_glob, output_data, run_start_time, song_df)
+        with stage(results, 'spark', 'local', 'process_log_data'):
+            users_table, time_table, songplays_table, log_df = \
+                etl.process_log_data(spark, log_glob, song_glob,
+                                     output_data, run_start_time, song_df)
+
+        row_counts['spark/local'] = {
+            'songplays': songplays_table.count(),
+            'users': users_table.count(),
+            'songs': songs_table.count(),
+            'artists': artists_table.count(),
+            'time': time_table.count()}
+        log_df.unpersist()
+        song_df.unpersist()
+        spark.stop()
+
+
+@click.command()
+@click.argument('data_dir', type=click.Path(exists=True))
+@click.option('--engines', default='postgres,spark', show_default=True,
+              help='Comma separated engines to run: '
+                   'postgres, spark, redshift, rehearsal.')
+@click.option('--postgres-modes', default='select,row,bulk',
+              show_default=True,
+              help='Comma separated data_model_postgres load modes: '
+                   '{}.'.format(', '.join(POSTGRES_MODES)))
+@click.option('--workers', default=os.cpu_count(), show_default=True,
+              help='Worker processes of the parallel postgres mode.')
+@click.option('--output', type=click.Path(), default=None,
+              help='Results JSON file '
+                   '[default: reports/benchmarks/benchmark-<time>.json].')
+def main(data_dir, engines, postgres_modes, workers, output):
+    """ Times each stage of the Sparkify pipelines on the song_data and
+        log_data in DATA_DIR (see src/data/make_sparkify_dataset.py) and writes
+        the results as JSON.
+
+        postgres loads the local sparkifydb of data_model_postgres, spark runs
+        data_lake_spark in local mode and redshift loads the cluster and S3
+        data configured in cloud_warehouse_aws/dwh.cfg. rehearsal runs the same
+        Redshift statements on a local Postgres database (see
+        cloud_warehouse_aws/rehearsal.py).
+    """
+    data_dir = os.path.abspath(data_dir)
+    started_at = datetime.now()
+    results, row_counts = [], {}
+    engines = engines.split(',')
+
+    if 'postgres' in engines:
+        for mode in postgres_modes.split(','):
+            if mode not in POSTGRES_MODES:
+                raise click.BadParameter(
+                    'unknown postgres mode {}'.format(mode))
+            run_postgres(data_dir, mode, workers, results, row_counts)
+    if 'redshift' in engines:
+        run_redshift(results, row_counts)
+    if 'rehearsal' in engines:
+        run_rehearsal(data_dir, results, row_counts)
+    if 'spark' in engines:
+        output_dir = tempfile.mkdtemp(prefix='sparkify-benchmark-')
+        try:
+            run_spark(data_dir, output_dir, results, row_counts)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    report = {
+        'started_at': started_at.isoformat(),
+        'finished_at': datetime.now().isoformat(),
+        'data_dir': data_dir,
+        'input': describe_input(data_dir),
+        'workers': workers,
+        'results': results,
+        'row_counts': row_counts,
+    }
+    if output is None:
+        output = PROJECT_DIR / 'reports' / 'benchmarks' / \
+            'benchmark-{:%Y%m%d-%H%M%S}.json'.format(started_at)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info('wrote benchmark results to {}'.format(output))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import click
+import importlib
+import json
+import logging
+import os
+import statistics
+import time
+from datetime import datetime
+
+from src.benchmark.run_benchmark import PROJECT_DIR, pipeline
+
+logger = logging.getLogger(__name__)
+
+
+def with_udf_event_time(df):
+    """ The timestamp and datetime columns as data_lake_spark/etl.py derived
+        them before transforms.with_event_time, through row at a time Python
+        UDFs.
+    """
+    from pyspark.sql import types as t
+    from pyspark.sql.functions import udf
+
+    @udf(t.TimestampType())
+    def get_timestamp(ts):
+        return datetime.fromtimestamp(ts / 1000.0)
+
+    @udf(t.StringType())
+    def get_datetime(ts):
+        return datetime.fromtimestamp(ts / 1000.0) \
+            .strftime('%Y-%m-%d %H:%M:%S')
+
+    return df.withColumn('timestamp', get_timestamp('ts')) \
+        .withColumn('datetime', get_datetime('ts'))
+
+
+def time_build(time_table):
+    """ Builds the time table without writing files, through the noop data
+        source.
+    """
+    start = time.perf_counter()
+    time_table.write.format('noop').mode('overwrite').save()
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.argument('data_dir', type=click.Path(exists=True))
+@click.option('--repeat', default=3, show_default=True,
+              help='Timed builds per variant.')
+@click.option('--output', type=click.Path(), default=None,
+              help='Results JSON file '
+                   '[default: reports/benchmarks/spark-udf-<time>.json].')
+def main(data_dir, repeat, output):
+    """ Times the time table build of data_lake_spark on the log_data in
+        DATA_DIR (see src/data/make_sparkify_dataset.py) with the former
+        Python UDFs and with the built-in expressions of transforms.py, and
+        checks both give the same rows.
+    """
+    # pipeline() changes into the pipeline directory
+    data_dir = os.path.abspath(data_dir)
+    started_at = datetime.now()
+    with pipeline('data_lake_spark'):
+        from pyspark.sql import SparkSession
+
+        transforms = importlib.import_module('transforms')
+        spark = SparkSession.builder.master('local[*]') \
+            .appName('sparkify-udf-benchmark').getOrCreate()
+
+        # the input is cached so only the derivation and the time table
+        # build are timed
+        events = spark.read.json(
+            os.path.join(data_dir, 'log_data', '*.json'))
+        events = events.filter(events.page == 'NextSong').cache()
+        num_events = events.count()
+
+        variants = {'udf': with_udf_event_time,
+                    'native': transforms.with_event_time}
+        tables = dict((name, transforms.get_time_table(derive(events)))
+                      for name, derive in variants.items())
+        mismatches = tables['udf'].exceptAll(tables['native']).count() + \
+            tables['native'].exceptAll(tables['udf']).count()
+
+        results = {}
+        for name, time_table in tables.items():
+            time_build(time_table)
+            seconds = [time_build(time_table) for _ in range(repeat)]
+            results[name] = {'seconds': [round(s, 6) for s in seconds],
+                             'median_seconds': statistics.median(seconds)}
+            logger.info('{}: median {:.3f}s of {} builds'.format(
+                name, results[name]['median_seconds'], repeat))
+        spark.stop()
+
+    speedup = results['udf']['median_seconds'] / \
+        results['native']['median_seconds']
+    logger.info('native is {:.1f}x faster, {} mismatching rows'.format(
+        speedup, mismatches))
+
+    report = {
+        'started_at': started_at.isoformat(),
+        'data_dir': data_dir,
+        'nextsong_events': num_events,
+        'repeat': repeat,
+        'results': results,
+        'speedup': round(speedup, 3),
+        'mismatching_rows': mismatches,
+    }
+    if output is None:
+        output = PROJECT_DIR / 'reports' / 'benchmarks' / \
+            'spark-udf-{:%Y%m%d-%H%M%S}.json'.format(started_at)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info('wrote benchmark results to {}'.format(output))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import click
+import json
+import logging
+import os
+import string
+from datetime import datetime, timedelta
+
+import numpy as np
+
+LETTERS = np.array(list(string.ascii_uppercase))
+ALPHANUMERIC = np.array(list(string.ascii_uppercase + string.digits))
+
+FIRST_NAMES = ['Walter', 'Kaylee', 'Anabelle', 'Aleena', 'Jacob', 'Layla',
+               'Tegan', 'Mohammad', 'Chloe', 'Lily', 'Jayden', 'Ryan', 'Kate',
+               'Matthew', 'Jizelle', 'Avery', 'Rylan', 'Sara']
+LAST_NAMES = ['Frye', 'Summers', 'Simpson', 'Kirby', 'Klein', 'Griffin',
+              'Levine', 'Rodriguez', 'Cuevas', 'Koch', 'Graham', 'Smith',
+              'Harrell', 'Jones', 'Benjamin', 'Martinez', 'George', 'Johnson']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA',
+             'Phoenix-Mesa-Scottsdale, AZ', 'Waterloo-Cedar Falls, IA',
+             'Philadelphia-Camden-Wilmington, PA-NJ-DE-MD',
+             'Chicago-Naperville-Elgin, IL-IN-WI',
+             'Atlanta-Sandy Springs-Roswell, GA',
+             'New York-Newark-Jersey City, NY-NJ-PA',
+             'Lansing-East Lansing, MI', 'Portland-South Portland, ME',
+             'Houston-The Woodlands-Sugar Land, TX']
+ARTIST_LOCATIONS = ['California - LA', 'Zagreb Croatia', 'Hamtramck, MI',
+                    'New York, NY', 'London, England', '']
+USER_AGENTS = [
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9; rv:31.0) Gecko/20100101 '
+    'Firefox/31.0',
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; WOW64; '
+    'Trident/6.0)',
+]
+WORDS = ['Love', 'Night', 'Heart', 'Fire', 'Rain', 'Blue', 'Dream', 'Road',
+         'Song', 'Light', 'Home', 'Time', 'Gold', 'River', 'Star', 'Ghost',
+         'Summer', 'City', 'Angel', 'Wild']
+
+# non NextSong pages of logged in users with their (method, status)
+OTHER_PAGES = [('Home', 'GET', 200), ('Logout', 'PUT', 307),
+               ('Downgrade', 'GET', 200), ('Settings', 'GET', 200),
+               ('Help', 'GET', 200), ('About', 'GET', 200),
+               ('Upgrade', 'GET', 200), ('Save Settings', 'PUT', 307),
+               ('Error', 'GET', 404)]
+
+
+def zipf_weights(n, exponent):
+    """ Returns normalised Zipf probabilities for ranks 1..n, so a few songs
+        and users account for most of the events.
+    """
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def make_ids(prefix, n, rng):
+    """ Returns n unique 18 character ids like TRAAAAW128F429D538.
+
+        The first three characters after the prefix spread the ids evenly over
+        the A/A/A style directories of song_data.
+    """
+    index = np.arange(n)
+    head = [LETTERS[(index // 26 ** k) % 26] for k in range(5)]
+    tail = rng.choice(ALPHANUMERIC, size=(n, 11))
+    return [prefix + ''.join(chars) for chars in zip(*head, *tail.T)]
+
+
+def make_titles(n, rng):
+    """ Returns n song or artist names made of one to three words. """
+    lengths = rng.integers(1, 4, size=n)
+    words = rng.choice(WORDS, size=(n, 3))
+    return ['{} {}'.format(' '.join(row[:k]), i)
+            for i, (row, k) in enumerate(zip(words, lengths))]
+
+
+def write_song_data(output_dir, num_songs, num_artists, rng):
+    """ Writes one JSON file per song in the song_data/X/Y/Z/TR*.json layout.
+
+        Returns the song catalog as a dict of title, artist name and duration
+        arrays used to generate matching log events.
+    """
+    artist_ids = make_ids('AR', num_artists, rng)
+    artist_names = make_titles(num_artists, rng)
+    artist_locations = rng.choice(ARTIST_LOCATIONS, size=num_artists)
+    has_coordinates = rng.random(num_artists) < 0.4
+    latitudes = rng.uniform(-60, 70, size=num_artists).round(5)
+    longitudes = rng.uniform(-150, 150, size=num_artists).round(5)
+
+    track_ids = make_ids('TR', num_songs, rng)
+    song_ids = make_ids('SO', num_songs, rng)
+    titles = make_titles(num_songs, rng)
+    song_artists = rng.integers(0, num_artists, size=num_songs)
+    durations = rng.uniform(90, 420, size=num_songs).round(5)
+    years = np.where(rng.random(num_songs) < 0.5, 0,
+                     rng.integers(1960, 2011, size=num_songs))
+
+    for i in range(num_songs):
+        a = song_artists[i]
+        located = has_coordinates[a]
+        song = {
+            "num_songs": 1,
+            "artist_id": artist_ids[a],
+            "artist_latitude": float(latitudes[a]) if located else None,
+            "artist_longitude": float(longitudes[a]) if located else None,
+            "artist_location": str(artist_locations[a]),
+            "artist_name": artist_names[a],
+            "song_id": song_ids[i],
+            "title": titles[i],
+            "duration": float(durations[i]),
+            "year": int(years[i]),
+        }
+        song_dir = os.path.join(output_dir, 'song_data', *track_ids[i][2:5])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, track_ids[i] + '.json'), 'w') as f:
+            json.dump(song, f)
+
+    return {'title': titles,
+            'artist': [artist_names[a] for a in song_artists],
+            'length': durations}
+
+
+def make_users(num_users, num_days, start, rng):
+    """ Returns the user attributes; some users upgrade from free to paid
+        during the period.
+    """
+    upgrade_day = np.where(rng.random(num_users) < 0.3,
+                           rng.integers(0, num_days, size=num_users), -1)
+    return {
+        'firstName': rng.choice(FIRST_NAMES, size=num_users),
+        'lastName': rng.choice(LAST_NAMES, size=num_users),
+        'gender': rng.choice(['M', 'F'], size=num_users),
+        'location': rng.choice(LOCATIONS, size=num_users),
+        'userAgent': rng.choice(USER_AGENTS, size=num_users),
+        'registration': [
+            float(start - int(r))
+            for r in rng.integers(1, 60, size=num_users) * 86400000],
+        'paid': rng.random(num_users) < 0.2,
+        'upgrade_day': upgrade_day,
+    }
+
+
+def write_log_day(path, day, day_start, num_events, catalog, song_p, users,
+                  user_p, other_rate, match_rate, rng):
+    """ Writes one day of newline delimited events, ordered by ts, to path. """
+    num_other = int(num_events * other_rate / (1 - other_rate))
+    total = num_events + num_other
+
+    ts = np.sort(day_start + rng.integers(0, 86400000, size=total))
+    is_song = np.zeros(total, dtype=bool)
+    is_song[rng.choice(total, size=num_events, replace=False)] = True
+    user = rng.choice(len(user_p), size=total, p=user_p)
+    song = rng.choice(len(song_p), size=total, p=song_p)
+    matched = rng.random(total) < match_rate
+    other = rng.integers(0, len(OTHER_PAGES), size=total)
+
+    item_in_session = {}
+    with open(path, 'w') as f:
+        for i in range(total):
+            u = user[i]
+            item = item_in_session.get(u, 0)
+            item_in_session[u] = item + 1
+            paid = users['paid'][u] or 0 <= users['upgrade_day'][u] <= day
+            event = {
+                "artist": None, "auth": "Logged In",
+                "firstName": users['firstName'][u],
+                "gender": users['gender'][u], "itemInSession": item,
+                "lastName": users['lastName'][u], "length": None,
+                "level": "paid" if paid else "free",
+                "location": users['location'][u], "method": "PUT",
+                "page": "NextSong",
+                "registration": users['registration'][u],
+                "sessionId": int(day * 1000 + u % 1000),
+                "song": None, "status": 200, "ts": int(ts[i]),
+                "userAgent": users['userAgent'][u],
+                "userId": str(u + 1),
+            }
+            if is_song[i]:
+                s = song[i]
+                event['artist'] = catalog['artist'][s]
+                event['song'] = catalog['title'][s]
+                # unmatched plays are songs that are missing from song_data
+                length = float(catalog['length'][s])
+                event['length'] = length if matched[i] else length + 1
+            else:
+                event['page'], event['method'], event['status'] = \
+                    OTHER_PAGES[other[i]]
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+
+@click.command()
+@click.argument('output_dir', type=click.Path())
+@click.option('--events', default=10000, show_default=True,
+              help='Number of NextSong events.')
+@click.option('--songs', default=None, type=int,
+              help='Number of song files [default: events / 10].')
+@click.option('--users', default=None, type=int,
+              help='Number of users [default: events / 100].')
+@click.option('--days', default=30, show_default=True,
+              help='Number of daily log files.')
+@click.option('--skew', default=1.1, show_default=True,
+              help='Zipf exponent of song and user popularity.')
+@click.option('--match-rate', default=0.9, show_default=True,
+              help='Fraction of NextSong events whose song is in song_data.')
+@click.option('--other-rate', default=0.15, show_default=True,
+              help='Fraction of non NextSong events.')
+@click.option('--seed', default=42, show_default=True, help='Random seed.')
+def main(output_dir, events, songs, users, days, skew, match_rate,
+         other_rate, seed):
+    """ Generates synthetic Sparkify song_data and log_data trees in
+        OUTPUT_DIR, in the JSON layout of the project data sets.
+    """
+    logger = logging.getLogger(__name__)
+    rng = np.random.default_rng(seed)
+    num_songs = songs or max(1, events // 10)
+    num_users = users or max(1, events // 100)
+
+    logger.info('writing {} song files'.format(num_songs))
+    catalog = write_song_data(output_dir, num_songs, max(1, num_songs // 3),
+                              rng)
+    song_p = zipf_weights(num_songs, skew)[rng.permutation(num_songs)]
+
+    start = int(datetime(2018, 11, 1).timestamp() * 1000)
+    user_data = make_users(num_users, days, start, rng)
+    user_p = zipf_weights(num_users, skew)[rng.permutation(num_users)]
+
+    log_dir = os.path.join(output_dir, 'log_data')
+    os.makedirs(log_dir, exist_ok=True)
+    per_day = np.full(days, events // days)
+    per_day[:events % days] += 1
+    for day in range(days):
+        date = datetime(2018, 11, 1) + timedelta(days=day)
+        path = os.path.join(log_dir, '{:%Y-%m-%d}-events.json'.format(date))
+        logger.info('writing {} events to {}'.format(per_day[day], path))
+        write_log_day(path, day, start + day * 86400000, int(per_day[day]),
+                      catalog, song_p, user_data, user_p, other_rate,
+                      match_rate, rng)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from psycopg2.extensions import cursor
+
+from src.instrumentation.metrics import metrics
+
+
+class CountingCursor(cursor):
+    """ psycopg2 cursor counting the statements it sends as database round
+        trips of the current stage; pass it as cursor_factory to
+        psycopg2.connect.
+    """
+
+    def execute(self, query, vars=None):
+        metrics.add(db_round_trips=1)
+        return super(CountingCursor, self).execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        metrics.add(db_round_trips=len(vars_list))
+        return super(CountingCursor, self).executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics.add(db_round_trips=1)
+        return super(CountingCursor, self).copy_expert(sql, file, size)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+
+# JSON run files go to METRICS_DIR, the Prometheus file to the node_exporter
+# textfile collector directory in TEXTFILE_DIR, both default to reports/metrics
+METRICS_DIR = os.environ.get('SPARKIFY_METRICS_DIR',
+                             str(PROJECT_DIR / 'reports' / 'metrics'))
+TEXTFILE_DIR = os.environ.get('SPARKIFY_TEXTFILE_DIR', METRICS_DIR)
+
+PROMETHEUS_PREFIX = 'sparkify_etl'
+
+COUNTERS = ('rows_read', 'rows_written', 'rows_rejected', 'bytes_processed',
+            'db_round_trips')
+
+# (metric, stage record key, help text) of the Prometheus export
+STAGE_METRICS = [
+    ('stage_seconds', 'seconds',
+     'Time spent in the stage during the last run, including nested stages.'),
+    ('stage_max_seconds', 'max_seconds',
+     'Longest single call of the stage during the last run.'),
+    ('stage_calls', 'calls', 'Calls of the stage during the last run.'),
+    ('rows_read', 'rows_read',
+     'Input rows read by the stage during the last run.'),
+    ('rows_written', 'rows_written',
+     'Rows sent to the target tables or files by the stage during the last '
+     'run.'),
+    ('rows_rejected', 'rows_rejected',
+     'Input rows dropped by the stage during the last run.'),
+    ('bytes_processed', 'bytes_processed',
+     'Input bytes processed by the stage during the last run.'),
+    ('db_round_trips', 'db_round_trips',
+     'Statements sent to the database by the stage during the last run.'),
+]
+
+# counters added to a stage beyond COUNTERS, e.g. the join strategy chosen,
+# are exported as this metric with the counter name as label
+EXTRA_COUNTER_METRIC = ('stage_counter',
+                        'Other counters of the stage during the last run.')
+
+
+def new_stage():
+    """ Returns an empty stage record. """
+    record = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+    record.update((counter, 0) for counter in COUNTERS)
+    return record
+
+
+class Metrics(object):
+    """ Collects per stage timings and counters of one ETL run.
+
+        Stages are aggregated by name, so a stage entered once per file reports
+        the total over all files. Counters are added to the innermost stage
+        open in the current thread and are dropped outside of any stage.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def open_stages(self):
+        """ Returns the names of the stages open in the current thread,
+            innermost last.
+        """
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def stage(self, name):
+        """ Times the enclosed block as one call of the named stage. """
+        stack = self.open_stages()
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                record = self.stages.setdefault(name, new_stage())
+                record['calls'] += 1
+                record['seconds'] += seconds
+                record['max_seconds'] = max(record['max_seconds'], seconds)
+
+    def instrument(self, name=None):
+        """ Decorator running each call of the function as a stage, named
+            after the function by default.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, **counts):
+        """ Adds to the counters of the innermost open stage,
+            e.g. add(rows_read=10). Counters beyond COUNTERS start at 0.
+        """
+        stack = self.open_stages()
+        if not stack:
+            return
+        with self.lock:
+            record = self.stages.setdefault(stack[-1], new_stage())
+            for counter, value in counts.items():
+                record[counter] = record.get(counter, 0) + int(value)
+
+    def drain(self):
+        """ Returns the stage records collected so far and resets them, to
+            send them to another process.
+        """
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def merge(self, stages):
+        """ Adds stage records returned by `drain` in a worker process to
+            this run.
+        """
+        with self.lock:
+            for name, other in stages.items():
+                record = self.stages.setdefault(name, new_stage())
+                for key, value in other.items():
+                    if key == 'max_seconds':
+                        record[key] = max(record[key], value)
+                    else:
+                        record[key] = record.get(key, 0) + value
+
+    def report(self, job):
+        """ Returns the run as a JSON serialisable dict. """
+        finished_at = datetime.now()
+        with self.lock:
+            stages = {name: dict(record, seconds=round(record['seconds'], 6),
+                                 max_seconds=round(record['max_seconds'], 6))
+                      for name, record in self.stages.items()}
+        seconds = (finished_at - self.started_at).total_seconds()
+        return {'job': job, 'started_at': self.started_at.isoformat(),
+                'finished_at': finished_at.isoformat(),
+                'seconds': round(seconds, 6), 'stages': stages}
+
+    def write(self, job, metrics_dir=None, textfile_dir=None):
+        """ Writes the run to <metrics_dir>/<job>-<time>.json and replaces the
+            Prometheus textfile collector file <textfile_dir>/<job>.prom.
+
+            Returns the paths of the JSON and Prometheus files.
+        """
+        report = self.report(job)
+        metrics_dir = metrics_dir or METRICS_DIR
+        textfile_dir = textfile_dir or TEXTFILE_DIR
+
+        os.makedirs(metrics_dir, exist_ok=True)
+        json_path = os.path.join(metrics_dir, '{}-{:%Y%m%d-%H%M%S}.json'
+                                 .format(job, self.started_at))
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        # the collector may read the file at any time, so it is replaced in
+        # one rename
+        os.makedirs(textfile_dir, exist_ok=True)
+        prom_path = os.path.join(textfile_dir, '{}.prom'.format(job))
+        tmp_path = '{}.{}.tmp'.format(prom_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(to_prometheus(report))
+        os.replace(tmp_path, prom_path)
+
+        return json_path, prom_path
+
+
+def escape_label(value):
+    """ Escapes a Prometheus label value. """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def to_prometheus(report):
+    """ Formats a run report in the Prometheus text exposition format, as
+        gauges of the last run.
+    """
+    job = escape_label(report['job'])
+    lines = []
+
+    def gauge(metric, help_text, samples):
+        name = '{}_{}'.format(PROMETHEUS_PREFIX, metric)
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} gauge'.format(name))
+        for labels, value in samples:
+            label_text = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+            lines.append('{}{{{}}} {}'.format(name, label_text, value))
+
+    finished_at = datetime.fromisoformat(report['finished_at'])
+    gauge('last_run_timestamp_seconds', 'End time of the last run.',
+          [([('job', job)], finished_at.timestamp())])
+    gauge('run_seconds', 'Duration of the last run.',
+          [([('job', job)], report['seconds'])])
+    for metric, key, help_text in STAGE_METRICS:
+        gauge(metric, help_text,
+              [([('job', job), ('stage', escape_label(name))], record[key])
+               for name, record in sorted(report['stages'].items())])
+
+    known = set(new_stage())
+    metric, help_text = EXTRA_COUNTER_METRIC
+    gauge(metric, help_text,
+          [([('job', job), ('stage', escape_label(name)),
+             ('counter', escape_label(counter))], value)
+           for name, record in sorted(report['stages'].items())
+           for counter, value in sorted(record.items())
+           if counter not in known])
+
+    return '\n'.join(lines) + '\n'
+
+
+# run of the current process, shared by the pipeline modules
+metrics = Metrics()